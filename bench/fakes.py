@@ -0,0 +1,259 @@
+"""In-process stand-ins for the AWS and OpenAI clients the dive agent talks to.
+
+Each fake sleeps for a configurable latency per call, so throughput numbers reflect
+the number and shape of round trips rather than a real network.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import re
+import shutil
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+def _client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+class Latency:
+    """Sleep for a fixed per-call latency and count calls per operation."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def count(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def hit(self, operation):
+        self.count(operation)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+class _Body:
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self):
+        return self._stream.read()
+
+class FakeS3(Latency):
+    """Dict-backed S3 client covering the calls made by src/ and front/."""
+
+    def __init__(self, latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.objects = {}
+
+    @staticmethod
+    def _etag(data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.hit("put_object")
+        data = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        with self._lock:
+            current = self.objects.get(Key)
+            if IfNoneMatch == "*" and current is not None:
+                raise _client_error("PreconditionFailed", "PutObject")
+            if IfMatch is not None and (current is None or self._etag(current) != IfMatch):
+                raise _client_error("PreconditionFailed", "PutObject")
+            self.objects[Key] = data
+        return {"ETag": self._etag(data)}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.hit("get_object")
+        data = self.objects.get(Key)
+        if data is None:
+            raise _client_error("NoSuchKey", "GetObject")
+        return {"Body": _Body(data), "ETag": self._etag(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.hit("head_object")
+        data = self.objects.get(Key)
+        if data is None:
+            raise _client_error("404", "HeadObject")
+        return {"ETag": self._etag(data), "ContentLength": len(data)}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def download_file(self, Bucket, Key, Filename):
+        obj = self.get_object(Bucket=Bucket, Key=Key)
+        with open(Filename, "wb") as f:
+            shutil.copyfileobj(obj["Body"]._stream, f)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return f"https://{Params['Bucket']}.s3.fake/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        return _ListPaginator(self)
+
+class _ListPaginator:
+    page_size = 1000
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix=""):
+        keys = sorted(key for key in self.s3.objects if key.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), self.page_size):
+            self.s3.hit("list_objects_v2")
+            yield {"Contents": [
+                {"Key": key, "ETag": self.s3._etag(self.s3.objects[key]), "Size": len(self.s3.objects[key])}
+                for key in keys[i:i + self.page_size]
+            ]}
+
+class FakeSecretsManager(Latency):
+    def __init__(self, api_key="sk-fake", latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.api_key = api_key
+
+    def get_secret_value(self, SecretId):
+        self.hit("get_secret_value")
+        return {"SecretString": json.dumps({"dive-analysis-openai-key": self.api_key})}
+
+class FakeOpenAI(Latency):
+    """OpenAI client whose Responses API returns a canned species identification.
+
+    Batched requests (with `clip="..."` markers in the prompt) get one JSON block per clip.
+    """
+
+    ANSWER = {
+        "filename": "frame_1_at_0.jpg",
+        "animal": "Reef Manta Ray",
+        "animals": ["Reef Manta Ray"],
+        "description": "Big manta cruising over the cleaning station.",
+        "confidence": 85,
+        "reasoning": "Clear view of the cephalic fins."
+    }
+
+    def __init__(self, latency_ms=0.0, **kwargs):
+        super().__init__(latency_ms)
+        self.responses = self
+        self.input_chars = 0
+
+    def create(self, model, input):
+        self.hit("responses.create")
+        self.input_chars += len(json.dumps(input))
+        prompt = "".join(part.get("text", "") for part in input[1]["content"])
+        clip_ids = re.findall(r'Clip IDs: (.*)', prompt)
+        if clip_ids:
+            ids = re.findall(r'"([^"]+)"', clip_ids[0])
+            text = "\n".join(f'<BEGIN_JSON clip="{clip_id}">{json.dumps(self.ANSWER)}<END_JSON>' for clip_id in ids)
+        else:
+            text = f"<BEGIN_JSON>{json.dumps(self.ANSWER)}<END_JSON>"
+        return type("Response", (), {"output_text": text})()
+
+class FakeBedrock(Latency):
+    """bedrock-runtime client that answers every message with a short text reply.
+
+    `latency_ms` is time to first token; `token_ms` is added per streamed chunk.
+    """
+
+    def __init__(self, latency_ms=0.0, token_ms=0.0, reply="G'day! Sounds like a ripper dive 🤿"):
+        super().__init__(latency_ms)
+        self.token_latency = token_ms / 1000.0
+        self.reply = reply
+
+    def _usage(self, body):
+        return {"input_tokens": len(body) // 4, "output_tokens": len(self.reply) // 4}
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self.hit("invoke_model")
+        words = self.reply.split(" ")
+        time.sleep(self.token_latency * len(words))
+        response = {"content": [{"type": "text", "text": self.reply}], "usage": self._usage(body)}
+        return {"body": _Body(json.dumps(response).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self.hit("invoke_model_with_response_stream")
+        return {"body": self._stream(body)}
+
+    def _stream(self, body):
+        def event(chunk):
+            return {"chunk": {"bytes": json.dumps(chunk).encode("utf-8")}}
+
+        yield event({"type": "message_start", "message": {"usage": self._usage(body)}})
+        yield event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for i, word in enumerate(self.reply.split(" ")):
+            time.sleep(self.token_latency)
+            yield event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word if i == 0 else " " + word}})
+        yield event({"type": "content_block_stop", "index": 0})
+        yield event({"type": "message_stop"})
+
+class _AsyncBody:
+    def __init__(self, data):
+        self._data = data
+
+    async def read(self):
+        return self._data
+
+class FakeAsyncBedrock(FakeBedrock):
+    """aioboto3-style bedrock-runtime client: same replies as FakeBedrock, awaited."""
+
+    async def invoke_model(self, modelId, body, **kwargs):
+        self.count("invoke_model")
+        await asyncio.sleep(self.latency + self.token_latency * len(self.reply.split(" ")))
+        response = {"content": [{"type": "text", "text": self.reply}], "usage": self._usage(body)}
+        return {"body": _AsyncBody(json.dumps(response).encode("utf-8"))}
+
+class FakeDynamoTable(Latency):
+    def __init__(self, latency_ms=0.0):
+        super().__init__(latency_ms)
+        self.items = {}
+
+    def get_item(self, Key):
+        self.hit("get_item")
+        item = self.items.get(Key["dive_id"])
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item):
+        self.hit("put_item")
+        self.items[Item["dive_id"]] = Item
+
+    def delete_item(self, Key):
+        self.hit("delete_item")
+        self.items.pop(Key["dive_id"], None)
+
+    def scan(self, ProjectionExpression=None, ExclusiveStartKey=None):
+        # One page holds everything; real scans page at 1 MB
+        self.hit("scan")
+        return {"Items": [{"dive_id": dive_id} for dive_id in self.items]}
+
+class FakeDynamoResource:
+    """Just enough of the DynamoDB resource for knowledge_base's batch reads and writes."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def Table(self, name):
+        return self.table
+
+    def batch_get_item(self, RequestItems):
+        self.table.hit("batch_get_item")
+        name, request = next(iter(RequestItems.items()))
+        items = [self.table.items[key["dive_id"]] for key in request["Keys"] if key["dive_id"] in self.table.items]
+        return {"Responses": {name: items}, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems):
+        self.table.hit("batch_write_item")
+        _, requests = next(iter(RequestItems.items()))
+        for request in requests:
+            if "PutRequest" in request:
+                item = request["PutRequest"]["Item"]
+                self.table.items[item["dive_id"]] = item
+            else:
+                self.table.items.pop(request["DeleteRequest"]["Key"]["dive_id"], None)
+        return {"UnprocessedItems": {}}
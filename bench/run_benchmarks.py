@@ -0,0 +1,548 @@
+"""Offline benchmarks for the dive agent.
+
+Runs the real pipeline, knowledge-base and chat code against the local fakes in
+bench/fakes.py, so no AWS or OpenAI access is needed. Results are written as JSON so
+runs from different versions can be diffed.
+
+    python bench/run_benchmarks.py --output bench_results.json
+    python bench/run_benchmarks.py --only extract_frames kb --kb-sessions 1000
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SRC = os.path.join(ROOT, "src")
+sys.path[:0] = [SRC, os.path.join(ROOT, "front"), os.path.dirname(os.path.abspath(__file__))]
+
+# Module-level boto3 clients are created at import time; they are swapped for fakes below
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-2")
+
+from fakes import (FakeBedrock, FakeDynamoResource, FakeDynamoTable, FakeOpenAI,
+                   FakeS3, FakeSecretsManager)
+from synthetic import make_dive_video
+
+logger = logging.getLogger("bench")
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def current_rss_mb():
+    # Second field of statm is resident pages (Linux only, like ru_maxrss above)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return None
+
+class PeakSampler:
+    """Samples thread count and resident memory in the background while a benchmark runs.
+
+    Reports the peak number of threads (not counting the sampler) and the peak RSS above
+    what the process used when sampling started, which covers thread stacks that
+    tracemalloc can't see.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_mb = None
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while True:
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            rss = current_rss_mb()
+            if rss is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb or 0, rss)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.baseline_rss_mb = current_rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def results(self):
+        return {
+            "peak_threads": self.peak_threads,
+            "peak_rss_growth_mb": (self.peak_rss_mb - self.baseline_rss_mb) if self.baseline_rss_mb is not None else None,
+        }
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else None
+
+# --- Benchmarks ---
+def bench_extract_frames(args, workdir):
+    import utils
+    from config import config
+    from extract_frames import extract_frames
+
+    video_path = os.path.join(workdir, "extract.mp4")
+    total_frames = make_dive_video(video_path, seconds=args.video_seconds, size=tuple(args.video_size))
+
+    s3 = FakeS3(args.s3_latency_ms)
+    utils.s3 = s3
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    frame_urls, preview_keys = extract_frames(
+        video_path, s3, "processed/bench/frames", config.MAX_FRAMES, config.FRAME_INTERVAL,
+        preview_prefix="processed/bench"
+    )
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = {
+        "frames": total_frames,
+        "seconds": elapsed,
+        "frames_per_s": total_frames / elapsed,
+        "peak_traced_mb": peak / 2 ** 20,
+        "peak_rss_mb": peak_rss_mb(),
+        "frames_selected": len(frame_urls),
+        "previews": sorted(preview_keys),
+    }
+
+    # Anytime mode under a deadline, as run_pipeline does inside Lambda
+    for budget in args.extract_budgets:
+        start = time.perf_counter()
+        anytime_urls, anytime_previews = extract_frames(
+            video_path, s3, "processed/bench/anytime", config.MAX_FRAMES, config.FRAME_INTERVAL,
+            preview_prefix="processed/bench", deadline=time.monotonic() + budget
+        )
+        results[f"anytime_{budget:g}s"] = {
+            "seconds": time.perf_counter() - start,
+            # Same winners as the full scan?
+            "frames_matching_full_scan": len(set(frame_indices(anytime_urls)) & set(frame_indices(frame_urls))),
+            "previews": sorted(anytime_previews),
+        }
+    return results
+
+def frame_indices(frame_urls):
+    return [int(url.split("?")[0].rsplit("_at_", 1)[1].split(".")[0]) for url in frame_urls]
+
+def bench_motion_prefilter(args, workdir):
+    """Scoring work and selection quality with and without the motion pre-filter."""
+    import cv2
+    import extract_frames as module
+    import utils
+    from config import config
+
+    video_path = os.path.join(workdir, "prefilter.mp4")
+    make_dive_video(video_path, seconds=args.video_seconds, size=tuple(args.video_size), static_fraction=0.7, seed=1)
+    s3 = FakeS3()
+    utils.s3 = s3
+
+    frame_scores = module.frame_scores
+    calls = {"n": 0}
+
+    def counting_frame_scores(frame, saliency_detector):
+        calls["n"] += 1
+        return frame_scores(frame, saliency_detector)
+
+    module.frame_scores = counting_frame_scores
+    results = {}
+    try:
+        for prefilter in (False, True):
+            calls["n"] = 0
+            start = time.perf_counter()
+            frame_urls, _ = module.extract_frames(
+                video_path, s3, "processed/bench/prefilter", config.MAX_FRAMES, config.FRAME_INTERVAL, prefilter=prefilter
+            )
+            results["filtered" if prefilter else "unfiltered"] = {
+                "seconds": time.perf_counter() - start,
+                "frames_scored": calls["n"],
+                "selected": frame_indices(frame_urls),
+            }
+    finally:
+        module.frame_scores = frame_scores
+
+    # Re-score both selections with the full scorer to compare quality
+    cap = cv2.VideoCapture(video_path)
+    detector = cv2.saliency.StaticSaliencySpectralResidual_create()
+
+    def total_score(indices):
+        total = 0.0
+        for idx in indices:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            _, frame = cap.read()
+            total += module.score_frame(frame, detector)
+        return total
+
+    unfiltered, filtered = results["unfiltered"], results["filtered"]
+    results["frames_pruned"] = unfiltered["frames_scored"] - filtered["frames_scored"]
+    results["speedup"] = unfiltered["seconds"] / filtered["seconds"]
+    # Mean score of the picks, filtered relative to unfiltered (1.0 = no loss)
+    results["selection_score_ratio"] = ((total_score(filtered["selected"]) / len(filtered["selected"]))
+                                        / (total_score(unfiltered["selected"]) / len(unfiltered["selected"])))
+    cap.release()
+    return results
+
+def bench_anytime_scan(args, workdir):
+    """Anytime extraction on a clip long enough for a coarse pass, against a full sequential scan."""
+    import extract_frames as module
+    import utils
+    from config import config
+
+    video_path = os.path.join(workdir, "anytime.mp4")
+    total_frames = make_dive_video(video_path, seconds=args.anytime_video_seconds, size=tuple(args.video_size))
+    candidates = -(-total_frames // config.FRAME_INTERVAL)
+    s3 = FakeS3()
+    utils.s3 = s3
+
+    frame_scores = module.frame_scores
+    calls = {"n": 0}
+
+    def counting_frame_scores(frame, saliency_detector):
+        calls["n"] += 1
+        return frame_scores(frame, saliency_detector)
+
+    module.frame_scores = counting_frame_scores
+    # A budget that is never reached measures the scan's overhead over a sequential decode
+    runs = {"sequential": None, "anytime_unbounded": 3600, **{f"anytime_{b:g}s": b for b in args.extract_budgets}}
+    results = {
+        "frames": total_frames,
+        "candidates": candidates,
+        "coarse_step": module.coarse_step(candidates, config.ANYTIME_COARSE_SAMPLES),
+    }
+    try:
+        for name, budget in runs.items():
+            calls["n"] = 0
+            start = time.perf_counter()
+            frame_urls, _ = module.extract_frames(
+                video_path, s3, "processed/bench/anytime", config.MAX_FRAMES, config.FRAME_INTERVAL, prefilter=False,
+                deadline=time.monotonic() + budget if budget is not None else None
+            )
+            results[name] = {
+                "seconds": time.perf_counter() - start,
+                "candidates_scored": calls["n"],
+                "selected": frame_indices(frame_urls),
+            }
+    finally:
+        module.frame_scores = frame_scores
+    return results
+
+def bench_run_pipeline(args, workdir):
+    import analyse_with_gpt
+    import config as config_module
+    import pipeline
+    import utils
+
+    video_path = os.path.join(workdir, "pipeline.mp4")
+    make_dive_video(video_path, seconds=args.video_seconds, size=tuple(args.video_size))
+
+    s3 = FakeS3(args.s3_latency_ms)
+    openai = FakeOpenAI(args.openai_latency_ms)
+    secrets = FakeSecretsManager(latency_ms=args.s3_latency_ms)
+    pipeline.s3 = utils.s3 = pipeline.metadata_store.s3 = s3
+    analyse_with_gpt.OpenAI = lambda api_key: openai
+    config_module.boto3 = SimpleNamespace(client=lambda *a, **k: secrets)
+
+    durations = []
+    for i in range(args.pipeline_runs):
+        s3_key = f"raw/bench_{i}.mp4"
+        with open(video_path, "rb") as f:
+            s3.objects[s3_key] = f.read()
+        start = time.perf_counter()
+        pipeline.run_pipeline(s3_key)
+        durations.append(time.perf_counter() - start)
+
+    return {
+        "runs": len(durations),
+        "mean_s": statistics.mean(durations),
+        "min_s": min(durations),
+        "s3_calls_per_run": s3.total_calls() / len(durations),
+        "openai_calls": openai.total_calls(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def populate_sessions(s3, count, dives_per_day=3):
+    for i in range(count):
+        session_id = f"bench{i:06d}"
+        prefix = f"dives/{session_id}"
+        day = i // (dives_per_day * 4)
+        s3.objects[f"{prefix}/gpt_output.json"] = json.dumps({**FakeOpenAI.ANSWER, "animal": f"Species {i % 50}"}).encode()
+        s3.objects[f"{prefix}/session_metadata.json"] = json.dumps({
+            "session_id": session_id,
+            "s3_key": f"raw/{session_id}.mp4",
+            "video_filename": f"{session_id}.mp4",
+            "dive_date": f"{2020 + day // 365}-{day % 12 + 1:02d}-{day % 28 + 1:02d}",
+            "dive_number": i % dives_per_day + 1,
+            "dive_location": f"Site {i % 20}",
+            "gpt_output_url": f"{prefix}/gpt_output.json",
+            "frame_urls": [f"https://fake/{prefix}/frames/frame_1_at_0.jpg"],
+        }).encode()
+
+def bench_update_knowledge_base(args, workdir):
+    import kb_index
+    import knowledge_base
+
+    results = {}
+    for count in args.kb_sessions:
+        s3 = FakeS3(args.s3_latency_ms)
+        table = FakeDynamoTable(args.dynamodb_latency_ms)
+        knowledge_base.s3 = kb_index.s3 = s3
+        knowledge_base.table = table
+        knowledge_base.dynamodb = FakeDynamoResource(table)
+        populate_sessions(s3, count)
+
+        start = time.perf_counter()
+        kb = knowledge_base.update_knowledge_base(full=True)
+        full_s = time.perf_counter() - start
+        full_gets = s3.calls.get("get_object", 0)
+
+        start = time.perf_counter()
+        knowledge_base.update_dynamodb_from_kb(kb)
+        sync_s = time.perf_counter() - start
+        sync_calls = table.total_calls()
+        # As sync_knowledge_base does once the sync succeeds
+        knowledge_base.save_manifest(kb["manifest"])
+
+        # Touch 1% of sessions, then refresh incrementally
+        for i in range(0, count, 100):
+            key = f"dives/bench{i:06d}/session_metadata.json"
+            s3.objects[key] = s3.objects[key].replace(b'"Site', b'"Moved site')
+        gets_before = s3.calls.get("get_object", 0)
+        start = time.perf_counter()
+        knowledge_base.update_knowledge_base()
+        incremental_s = time.perf_counter() - start
+
+        results[str(count)] = {
+            "dives": len(kb["dives"]),
+            "full_rebuild_s": full_s,
+            "full_objects_per_s": full_gets / full_s,
+            "dynamodb_sync_s": sync_s,
+            "dynamodb_round_trips": sync_calls,
+            "incremental_1pct_s": incremental_s,
+            # includes reading the manifest
+            "incremental_gets": s3.calls.get("get_object", 0) - gets_before,
+        }
+    return results
+
+def per_item_dynamodb_sync(table, kb):
+    """The sync as it was before batching: one get_item per dive and a put_item per change."""
+    for dive_id, dive_data in kb["dives"].items():
+        existing_item = table.get_item(Key={"dive_id": dive_id}).get("Item", {})
+        new_data = {
+            "dive_id": dive_id,
+            "dive_date": dive_data["dive_date"],
+            "dive_number": dive_data["dive_number"],
+            "dive_location": dive_data["dive_location"],
+            "sessions": dive_data["sessions"],
+            "species_seen": dive_data["species_seen"]
+        }
+        if existing_item != new_data:
+            table.put_item(Item=new_data)
+
+def bench_dynamodb_sync(args, workdir):
+    """DynamoDB round trips and time for the per-item and batched syncs, on an empty table and on a re-sync."""
+    import kb_index
+    import knowledge_base
+
+    results = {}
+    for count in args.kb_sessions:
+        s3 = FakeS3()
+        knowledge_base.s3 = kb_index.s3 = s3
+        populate_sessions(s3, count)
+        # The dives only, so both paths get the same input
+        kb = {"dives": knowledge_base.update_knowledge_base(full=True)["dives"]}
+
+        runs = {}
+        for name in ("per_item", "batched"):
+            table = FakeDynamoTable(args.dynamodb_latency_ms)
+            knowledge_base.table = table
+            knowledge_base.dynamodb = FakeDynamoResource(table)
+            for phase in ("empty_table", "unchanged"):
+                calls_before = table.total_calls()
+                start = time.perf_counter()
+                if name == "per_item":
+                    per_item_dynamodb_sync(table, kb)
+                else:
+                    assert knowledge_base.update_dynamodb_from_kb(kb)["ok"]
+                runs[f"{name}_{phase}"] = {
+                    "seconds": time.perf_counter() - start,
+                    "round_trips": table.total_calls() - calls_before,
+                }
+
+        results[str(count)] = {"dives": len(kb["dives"]), **runs}
+    return results
+
+def chat_results(args, latencies, elapsed, bedrock, **extra):
+    return {
+        "sessions": args.chat_sessions,
+        "turns": len(latencies),
+        "seconds": elapsed,
+        "turns_per_s": len(latencies) / elapsed,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "bedrock_calls": bedrock.total_calls(),
+        **extra,
+    }
+
+def patch_chat_clients(args, dive_agent_bedrock):
+    from rate_limiter import TokenBucketLimiter
+
+    s3 = FakeS3(args.s3_latency_ms)
+    dive_agent_bedrock.s3 = dive_agent_bedrock.metadata_store.s3 = s3
+    # Measure the agent, not the production quota
+    limiter = TokenBucketLimiter("bench", 10 ** 9)
+    dive_agent_bedrock.bedrock_limiter = limiter
+    return limiter
+
+def bench_chat_sessions(args, workdir):
+    """Synchronous agent: one thread per conversation, as Streamlit runs each session."""
+    import dive_agent_bedrock
+    from chat_session import ChatSession
+
+    bedrock = FakeBedrock(args.bedrock_latency_ms, args.token_latency_ms)
+    dive_agent_bedrock.bedrock = bedrock
+    patch_chat_clients(args, dive_agent_bedrock)
+
+    latencies = []
+    lock = threading.Lock()
+
+    def converse(n):
+        chat = ChatSession(available_tools=dive_agent_bedrock.ALL_TOOLS)
+        dive_agent_bedrock.start_chat(chat)
+        for turn in range(args.chat_turns):
+            start = time.perf_counter()
+            dive_agent_bedrock.continue_chat(chat, f"Session {n} turn {turn}: what did we see on the last dive?")
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=converse, args=(n,)) for n in range(args.chat_sessions)]
+    tracemalloc.start()
+    with PeakSampler() as sampler:
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return chat_results(args, latencies, elapsed, bedrock, peak_traced_mb=peak / 2 ** 20, **sampler.results())
+
+def bench_chat_sessions_async(args, workdir):
+    """Async agent: every conversation on one event loop."""
+    import asyncio
+
+    import dive_agent_async
+    import dive_agent_bedrock
+    from chat_session import ChatSession
+    from fakes import FakeAsyncBedrock
+
+    bedrock = FakeAsyncBedrock(args.bedrock_latency_ms, args.token_latency_ms)
+    dive_agent_async._clients["bedrock-runtime"] = bedrock
+    dive_agent_async.bedrock_limiter = patch_chat_clients(args, dive_agent_bedrock)
+
+    latencies = []
+
+    async def converse(n):
+        chat = ChatSession(available_tools=dive_agent_bedrock.ALL_TOOLS)
+        await dive_agent_async.start_chat(chat)
+        for turn in range(args.chat_turns):
+            start = time.perf_counter()
+            await dive_agent_async.continue_chat(chat, f"Session {n} turn {turn}: what did we see on the last dive?")
+            latencies.append(time.perf_counter() - start)
+
+    async def run_all():
+        await asyncio.gather(*(converse(n) for n in range(args.chat_sessions)))
+
+    tracemalloc.start()
+    with PeakSampler() as sampler:
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    dive_agent_async._clients.clear()
+
+    return chat_results(args, latencies, elapsed, bedrock, peak_traced_mb=peak / 2 ** 20, **sampler.results())
+
+BENCHMARKS = {
+    "extract_frames": bench_extract_frames,
+    "prefilter": bench_motion_prefilter,
+    "anytime": bench_anytime_scan,
+    "pipeline": bench_run_pipeline,
+    "kb": bench_update_knowledge_base,
+    "dynamodb_sync": bench_dynamodb_sync,
+    "chat": bench_chat_sessions,
+    "chat_async": bench_chat_sessions_async,
+}
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline dive agent benchmarks")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--video-seconds", type=float, default=20)
+    parser.add_argument("--video-size", type=int, nargs=2, default=[640, 360], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--anytime-video-seconds", type=float, default=120, help="Clip length for the anytime benchmark")
+    parser.add_argument("--extract-budgets", type=float, nargs="*", default=[1, 5], help="Anytime extraction deadlines to try, in seconds")
+    parser.add_argument("--pipeline-runs", type=int, default=3)
+    parser.add_argument("--kb-sessions", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--chat-sessions", type=int, default=100)
+    parser.add_argument("--chat-turns", type=int, default=3)
+    parser.add_argument("--s3-latency-ms", type=float, default=5)
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=5)
+    parser.add_argument("--openai-latency-ms", type=float, default=500)
+    parser.add_argument("--bedrock-latency-ms", type=float, default=300)
+    parser.add_argument("--token-latency-ms", type=float, default=10)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(message)s")
+    # The code under test logs every request; keep benchmark output readable
+    for name in ("knowledge_base", "kb_index", "extract_frames", "pipeline", "utils", "metadata_store",
+                 "analyse_with_gpt", "dive_agent_bedrock", "dive_agent_async", "rate_limiter", "botocore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    # load_system_prompt reads from the working directory, as it does in the Lambda image
+    os.chdir(SRC)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.only or BENCHMARKS:
+            logger.info(f"Running {name}...")
+            results[name] = BENCHMARKS[name](args, workdir)
+            logger.info(f"{name}: {json.dumps(results[name])}")
+
+    report = {
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "results": results,
+    }
+    output = os.path.join(ROOT, args.output) if not os.path.isabs(args.output) else args.output
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote results to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,24 @@ GET_GPT_TOOL = None
 
 MessageRole = Literal["user", "assistant", "tool"]
 
+# Tools that act on the uploaded video, so they are hidden until one exists
+VIDEO_TOOLS = {"update_dive_information"}
+
+SYSTEM_EVENT_PREFIX = "[SYSTEM_EVENT]"
+TOOL_RESULT_PREFIX = "[SYSTEM_EVENT] Tool "
+
+def approx_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token), good enough for budgeting context."""
+    return max(1, len(text) // 4)
+
 @dataclass
 class ChatSession:
-    """Manages a chat session with message history and dive integration."""
+    """Manages a chat session with message history and dive integration.
+
+    `messages` keeps the full transcript for display. What is sent to Claude comes from
+    `context_messages()`, a sliding window of recent turns capped at `max_context_tokens`,
+    with older turns folded into a short summary.
+    """
 
     id: str = field(default_factory=lambda: str(uuid4()))
     messages: List[Dict] = field(default_factory=list)
@@ -20,6 +35,14 @@ class ChatSession:
 
     available_tools: List[dict] = field(default_factory=list)
 
+    # Context window bookkeeping
+    token_counts: List[int] = field(default_factory=list)
+    max_context_tokens: int = 3000
+    keep_recent: int = 6
+    max_summary_lines: int = 20
+    summary_lines: List[str] = field(default_factory=list)
+    window_start: int = 0
+
     def add(self, role: MessageRole, text: str) -> None:
         """Add a message to the chat session with validation.
         
@@ -37,11 +60,84 @@ class ChatSession:
             raise ValueError("Message text must be a string")
 
         self.messages.append({"role": role, "content": text})
+        self.token_counts.append(approx_tokens(text))
+
+    def reset(self) -> None:
+        """Clear the transcript and any compacted context."""
+        self.messages.clear()
+        self.token_counts.clear()
+        self.summary_lines.clear()
+        self.window_start = 0
+
+    def compact(self) -> None:
+        """Fold the oldest turns into the summary until the window fits the token budget.
+
+        Whole turns are folded at a time, so the window always starts on a user message
+        (not a tool result) and keeps at least `keep_recent` messages.
+        """
+        while sum(self.token_counts[self.window_start:]) > self.max_context_tokens:
+            next_turn = next(
+                (i for i in range(self.window_start + 1, len(self.messages)) if self._is_turn_start(self.messages[i])),
+                None
+            )
+            if next_turn is None or len(self.messages) - next_turn < self.keep_recent:
+                break
+            while self.window_start < next_turn:
+                self._fold_oldest()
+
+    @staticmethod
+    def _is_turn_start(message: Dict) -> bool:
+        return message["role"] == "user" and not message["content"].startswith(TOOL_RESULT_PREFIX)
+
+    def _fold_oldest(self) -> None:
+        message = self.messages[self.window_start]
+        self.window_start += 1
+
+        # Tool results and other system events are not worth keeping once compacted
+        if message["content"].startswith(SYSTEM_EVENT_PREFIX):
+            return
+        first_line = message["content"].strip().splitlines()[0]
+        self.summary_lines.append(f"- {message['role']}: {first_line[:160]}")
+        del self.summary_lines[:-self.max_summary_lines]
+
+    def context_messages(self) -> List[Dict]:
+        """Return the bounded message list to send to Claude."""
+        self.compact()
+        window = self.messages[self.window_start:]
+
+        # Only the latest tool result is still relevant. Never drop the first message,
+        # so the window keeps starting with a user turn.
+        last_tool_result = max(
+            (i for i, m in enumerate(window) if m["content"].startswith(TOOL_RESULT_PREFIX)),
+            default=None
+        )
+        window = [
+            m for i, m in enumerate(window)
+            if i == 0 or i == last_tool_result or not m["content"].startswith(TOOL_RESULT_PREFIX)
+        ]
+
+        context = []
+        for message in window:
+            # Pruning can leave two turns from the same role next to each other
+            if context and context[-1]["role"] == message["role"]:
+                context[-1] = {"role": message["role"], "content": context[-1]["content"] + "\n\n" + message["content"]}
+            else:
+                context.append(dict(message))
+
+        if self.summary_lines and context:
+            summary = f"{SYSTEM_EVENT_PREFIX} conversation_summary: Earlier in this conversation:\n" + "\n".join(self.summary_lines)
+            context[0]["content"] = summary + "\n\n" + context[0]["content"]
+
+        return context
+
+    def context_tokens(self) -> int:
+        """Approximate tokens in the current context window (excluding the summary)."""
+        return sum(self.token_counts[self.window_start:])
 
     def next_tools(self) -> List:
         """ Return only the tools Claude may see right now."""
         if self.dive_session_id is None: #no video yet
-            return []
+            return [tool for tool in self.available_tools if tool["name"] not in VIDEO_TOOLS]
         #metadata_done = all(self.current_dive.get(field) for field in ["dive_date", "dive_number", "dive_location"])
         #return [] if metadata_done else self.available_tools
         return self.available_tools
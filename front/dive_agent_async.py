@@ -0,0 +1,146 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from chat_session import ChatSession
+from config import config
+from dive_agent_bedrock import (ALL_TOOLS, BUSY_REPLY, EMPTY_REPLY, bedrock_error_reply, bedrock_limiter, build_request,
+                                final_text, find_tool_call, log_token_usage, metadata_store, run_tool_call)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Concurrent Bedrock requests one event loop can have in flight
+MAX_CONCURRENT_REQUESTS = 100
+# Follow-up calls allowed after tool calls within one user turn
+MAX_TOOL_ROUNDS = 5
+
+_clients = {}
+_clients_lock = asyncio.Lock()
+_exit_stack = contextlib.AsyncExitStack()
+
+async def get_client(service):
+    """The process's async client for an AWS service, opened on first use."""
+    if service in _clients:
+        return _clients[service]
+
+    # Sessions starting together would otherwise each open a client
+    async with _clients_lock:
+        if service not in _clients:
+            # Front end only dependency (pip install aioboto3), imported on first real AWS call
+            import aioboto3
+            _clients[service] = await _exit_stack.enter_async_context(aioboto3.Session().client(
+                service,
+                region_name=config.REGION,
+                config=BotoConfig(max_pool_connections=MAX_CONCURRENT_REQUESTS)
+            ))
+    return _clients[service]
+
+async def close_clients():
+    _clients.clear()
+    await _exit_stack.aclose()
+
+async def run_tool(chat: ChatSession, tool_call):
+    """Run a tool call off the event loop, so S3 reads (e.g. the dive index) don't stall other sessions.
+
+    update_dive_information only queues a write-behind update, which metadata_store
+    flushes on its own timer thread.
+    """
+    return await asyncio.to_thread(run_tool_call, chat, tool_call)
+
+# --- Conversation Logic ---
+async def start_chat(chat: ChatSession):
+    chat.reset()
+    chat.add("user", "[SYSTEM_EVENT] start_conversation")
+    return await invoke_claude(chat, include_tools=False)
+
+async def continue_chat(chat: ChatSession, user_input):
+    chat.add("user", user_input)
+    has_tools = bool(chat.next_tools())
+    return await invoke_claude(chat, include_tools=has_tools)
+
+async def call_bedrock(body, max_retries = 4, client_id = "default"):
+    """Invoke Claude once the shared rate limiter grants a token.
+
+    Returns (response_body, None) on success or (None, apology) once retries run out.
+    """
+    bedrock = await get_client("bedrock-runtime")
+
+    for attempt in range(max_retries + 1):
+        try:
+            await bedrock_limiter.acquire_async(client_id, timeout=config.RATE_LIMIT_TIMEOUT)
+        except TimeoutError as e:
+            logger.error(str(e))
+            return None, BUSY_REPLY
+
+        try:
+            response = await bedrock.invoke_model(**body)
+            return json.loads(await response["body"].read()), None
+        except ClientError as e:
+            error_reply = bedrock_error_reply(e, attempt, max_retries)
+            if error_reply:
+                return None, error_reply
+
+async def invoke_claude(chat: ChatSession, include_tools=False, tool_prompt = "", max_retries = 4):
+    """Async invoke_claude: tool calls are answered in a loop rather than by recursion."""
+    replies = []
+
+    for _ in range(MAX_TOOL_ROUNDS + 1):
+        body = build_request(chat, include_tools, tool_prompt)
+
+        start_time = time.time()
+        response_body, error_reply = await call_bedrock(body, max_retries, chat.id)
+        if error_reply:
+            replies.append(error_reply)
+            break
+        logger.info(f"⏱️ Claude replied in {time.time() - start_time:.2f}s")
+        log_token_usage(response_body.get("usage"))
+
+        content = response_body.get("content", [])
+        tool_call = find_tool_call(content)
+        if tool_call is None:
+            reply = final_text(content)
+            if reply:
+                chat.add("assistant", reply)
+                replies.append(reply)
+            else:
+                replies.append(EMPTY_REPLY)
+            break
+
+        replies.append(tool_call.reply)
+        tool_prompt = await run_tool(chat, tool_call)
+        # The follow-up only reports on the result, so it gets no tools
+        include_tools = False
+    else:
+        logger.warning(f"Stopped after {MAX_TOOL_ROUNDS} tool rounds in one turn")
+
+    return "\n\n".join(replies)
+
+async def main():
+    logger.info("🎬 Async Dive Agent Started – Type 'exit' to quit\n")
+    chat = ChatSession(available_tools=ALL_TOOLS)
+    print(f"\nClaude: {await start_chat(chat)}")
+
+    try:
+        while True:
+            user_reply = await asyncio.to_thread(input, "\nYou: ")
+            if user_reply.strip().lower() in ["exit", "quit"]:
+                logger.info("Exiting session.")
+                break
+            print(f"\nClaude: {await continue_chat(chat, user_reply)}")
+    finally:
+        await asyncio.to_thread(metadata_store.close)
+        await close_clients()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,4 @@
+import functools
 import json
 import logging
 import os
@@ -5,6 +6,7 @@ import sys
 import time
 from datetime import datetime
 import re
+from typing import NamedTuple
 
 import boto3
 from botocore.exceptions import ClientError
@@ -13,6 +15,9 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "s
 
 from chat_session import ChatSession
 from config import config
+from kb_index import get_index, query_dives
+from metadata_store import SessionMetadataStore
+from rate_limiter import get_limiter
 from utils import load_json_from_s3
 
 # Configure logging
@@ -21,10 +26,20 @@ logger = logging.getLogger(__name__)
 
 # Model configuration
 MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+MAX_SEARCH_RESULTS = 20
+MAX_LOGGED_PAYLOAD_CHARS = 2000
 
 # Initialise AWS clients
 bedrock = boto3.client("bedrock-runtime", region_name=config.REGION)
 s3 = boto3.client("s3", region_name=config.REGION)
+metadata_store = SessionMetadataStore(s3)
+
+# Shared by every chat session in this process
+bedrock_limiter = get_limiter(MODEL_ID, config.BEDROCK_RPM)
+
+BUSY_REPLY = "🤖 Sorry, I'm currently experiencing high demand. Please try again."
+ERROR_REPLY = "🤖 Sorry, I experienced an error. Please try again."
+EMPTY_REPLY = "🤖 Sorry, I didn’t catch that."
 
 UPDATE_DIVE_INFORMATION_TOOL = {
     "name": "update_dive_information",
@@ -46,7 +61,27 @@ UPDATE_DIVE_INFORMATION_TOOL = {
     }
 }
 
-ALL_TOOLS = [UPDATE_DIVE_INFORMATION_TOOL]
+SEARCH_DIVES_TOOL = {
+    "name": "search_dives",
+    "description": (
+        "Use this tool to look up past dives in the user's dive log. "
+        "Filter by any combination of `species` (e.g. 'manta'), `dive_location`, and an inclusive `start_date`/`end_date` range. "
+        "Returns the matching dives with their date, number, location and sessions."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "species":       {"type": "string"},
+            "dive_location": {"type": "string"},
+            "start_date":    {"type": "string",
+                              "pattern": "^[0-9]{4}-[0-9]{2}-[0-9]{2}$"},
+            "end_date":      {"type": "string",
+                              "pattern": "^[0-9]{4}-[0-9]{2}-[0-9]{2}$"}
+        }
+    }
+}
+
+ALL_TOOLS = [UPDATE_DIVE_INFORMATION_TOOL, SEARCH_DIVES_TOOL]
 
 # --- Tool: Update metadata ---
 def update_dive_information(chat: ChatSession, dive_date=None, dive_number=None, dive_location=None):
@@ -93,26 +128,48 @@ def update_dive_information(chat: ChatSession, dive_date=None, dive_number=None,
         chat.current_dive["dive_location"] = dive_location
     logger.info(f"Updated dive information: {chat.current_dive}")
 
-    updated_key = f"processed/{session_id}/session_metadata.json"
+    # Only the fields the user gave are persisted, merged into the stored document in the background
+    updated_fields = {k: chat.current_dive[k] for k in ("dive_date", "dive_number", "dive_location") if k in chat.current_dive}
+    metadata_store.update(session_id, **updated_fields)
+
+    return chat.current_dive
+
+# --- Tool: Search the dive log ---
+def search_dives(chat: ChatSession, species=None, dive_location=None, start_date=None, end_date=None):
+    if not any((species, dive_location, start_date, end_date)):
+        return {"error": "Please give a species, location or date range to search for."}
 
     try:
-        s3.put_object(
-            Bucket=config.BUCKET_NAME,
-            Key=updated_key,
-            Body=json.dumps(chat.current_dive, indent=2),
-            ContentType="application/json"
-        )
-        logger.info(f"✅ Session metadata saved to s3://{config.BUCKET_NAME}/{updated_key}")
-
-        verify_obj = s3.get_object(Bucket=config.BUCKET_NAME, Key=updated_key)
-        verify_data = verify_obj["Body"].read().decode("utf-8")
-        logger.info(f"🔍 Verification read from S3: {verify_data}")
-
-        return chat.current_dive
+        dives = query_dives(get_index(), species=species, location=dive_location, start_date=start_date, end_date=end_date)
     except Exception as e:
-        logger.error(f"❌ Failed to update session metadata in S3: {e}")
+        logger.error(f"❌ Failed to search the dive log: {e}")
         return {"error": str(e)}
 
+    logger.info(f"🔍 search_dives matched {len(dives)} dives")
+    return {"match_count": len(dives), "dives": dives[:MAX_SEARCH_RESULTS]}
+
+TOOL_HANDLERS = {
+    "update_dive_information": update_dive_information,
+    "search_dives": search_dives,
+}
+
+def execute_tool(chat: ChatSession, tool_name, args):
+    handler = TOOL_HANDLERS.get(tool_name)
+    if handler is None:
+        logger.warning(f"Claude called an unknown tool: {tool_name}")
+        return {"error": f"Unknown tool: {tool_name}"}
+    result = handler(chat, **(args or {}))
+
+    # Dive details are saved in the background, so a failed save only shows up now
+    flush_error = metadata_store.pop_error(chat.dive_session_id)
+    if flush_error:
+        logger.warning(f"Reporting failed metadata save for {chat.dive_session_id}: {flush_error}")
+        return {
+            "error": f"Earlier dive details haven't been saved to the dive log yet ({flush_error}). They will be retried.",
+            "result": result
+        }
+    return result
+
 # --- Claude setup ---
 SYSTEM_PROMPT = """
 🧠 **ROLE & PURPOSE**
@@ -128,6 +185,7 @@ Only invoke one skill per message. If it shows **None**, do **not** call any too
 - DO NOT just describe calling it or show code examples  
 - DO NOT use backticks or pretty formatting - actually invoke the tool
 - If you mention "🔧 Claude is calling:" you MUST be actually calling a tool, not just talking about it
+- Only mention tools in text if you cannot determine what to update
 
 **Tool: update_dive_information**
 - **Valid inputs**: `dive_date`, `dive_number`, `dive_location`
@@ -136,6 +194,11 @@ Only invoke one skill per message. If it shows **None**, do **not** call any too
 - After saving, respond: **"✅ I've updated your dive log with that info."**
 - Only these three fields are valid. **Do not** ask for or infer other fields (e.g., depth, duration).
 
+**Tool: search_dives**
+- Use it when the user asks about past dives, e.g. "every dive where we saw a manta" or "what did we see at Manly in March?"
+- **Valid inputs**: `species`, `dive_location`, `start_date`, `end_date` (YYYY-MM-DD). Pass only what the user asked about.
+- Summarise the matching dives by date, dive number and location. If nothing matches, say so plainly.
+
 ⚙️ **BEHAVIOR GUIDELINES**
 - **Never guess** or autofill missing values; only use exactly what the user gives, in **correct formats** (YYYY-MM-DD for dates).
 - Only call the tool when **all required inputs** are clearly provided and valid.
@@ -152,15 +215,6 @@ Only invoke one skill per message. If it shows **None**, do **not** call any too
 4. Once fields are valid, call **update_dive_information**, then acknowledge.
 5. After acknowledgement, wait for the next user request and do not mix tasks.
 
-🔄 **CONVERSATION FLOW**
-1. On `[SYSTEM_EVENT] start_conversation` or when the user says “Howdy!”, introduce yourself: “Howdy! I’m Claudey, your dive-buddy assistant.”
-2. Identify the current task (e.g., updating metadata vs. answering dive questions).
-3. If metadata fields are missing:
-   - **First-time**: ask for all three fields together.
-   - **Subsequent**: ask only for missing or corrected fields.
-4. Once fields are valid, call **update_dive_information**, then acknowledge.
-5. After acknowledgement, wait for the next user request and do not mix tasks.
-
 📡 **SYSTEM EVENTS**
 - You may receive:
   - `[SYSTEM_EVENT] start_conversation`
@@ -172,16 +226,52 @@ Only invoke one skill per message. If it shows **None**, do **not** call any too
 - Keep replies **clear, concise, and helpful**.
 - Use emojis: 🐠, 🤿, ✅.
 - If you need multiple pieces of info, **ask in one message** to stay efficient.
-
-**CRITICAL TOOL USAGE:**
-- When the user provides dive information to update, you MUST actually call the update_dive_information tool
-- Do NOT just say you're calling it - actually use the tool system to call it
-- Only mention tools in text if you cannot determine what to update
 """
 
+# --- Static prompt prefix ---
+# Bedrock models that accept cache_control breakpoints. Matched as substrings so
+# cross-region inference profile IDs (e.g. "us.anthropic...") are covered too.
+PROMPT_CACHING_MODELS = (
+    "anthropic.claude-3-5-haiku-20241022",
+    "anthropic.claude-3-7-sonnet-20250219",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+)
+
+def supports_prompt_caching(model_id=MODEL_ID):
+    return any(model in model_id for model in PROMPT_CACHING_MODELS)
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Built once: the system prompt block every request starts with
+STATIC_SYSTEM_BLOCK = {"type": "text", "text": SYSTEM_PROMPT}
+if supports_prompt_caching():
+    STATIC_SYSTEM_BLOCK["cache_control"] = CACHE_CONTROL
+
+TOOLS_BY_NAME = {tool["name"]: tool for tool in ALL_TOOLS}
+
+@functools.lru_cache(maxsize=None)
+def static_tools(tool_names):
+    """Tool definitions for a given tool set, built once and marked for caching."""
+    tools = [dict(TOOLS_BY_NAME[name]) for name in tool_names]
+    if tools and supports_prompt_caching():
+        tools[-1]["cache_control"] = CACHE_CONTROL
+    return tools
+
+def log_token_usage(usage):
+    """Report cached versus uncached input tokens for one Claude call."""
+    if not usage:
+        return
+    logger.info(
+        f"🧮 Input tokens: {usage.get('input_tokens', 0)} uncached, "
+        f"{usage.get('cache_read_input_tokens', 0)} read from cache, "
+        f"{usage.get('cache_creation_input_tokens', 0)} written to cache | "
+        f"output tokens: {usage.get('output_tokens', 0)}"
+    )
+
 # --- Conversation Logic ---
 def start_chat(chat: ChatSession):
-    chat.messages.clear()
+    chat.reset()
     chat.add("user", "[SYSTEM_EVENT] start_conversation")
     return invoke_claude(chat, include_tools=False)
 
@@ -215,124 +305,254 @@ def parse_fake_tool_call(text):
 
     return tool_name, None
     
-def invoke_claude(chat: ChatSession, include_tools=False, tool_prompt = "", max_retries = 4):
+class ToolCall(NamedTuple):
+    name: str
+    args: dict
+    # The assistant's text before the call, and the notice shown for a real tool_use ("" for a fake call)
+    text: str
+    notice: str
+
+    @property
+    def reply(self):
+        return self.text + self.notice
+
+    @property
+    def real(self):
+        return bool(self.notice)
+
+def find_tool_call(content):
+    """The first tool call in a reply's content blocks, real tool_use or fake text call, or None."""
+    assistant_reply = ""
+
+    for message in content:
+        if message["type"] == "text":
+            assistant_reply = message["text"]
+
+            # Check for fake tool calls
+            if "🔧 Claude is calling:" in assistant_reply:
+                tool_name, fake_args = parse_fake_tool_call(assistant_reply)
+                if tool_name and fake_args:
+                    return ToolCall(tool_name, fake_args, assistant_reply, "")
+
+        elif message["type"] == "tool_use":
+            tool = message["name"]
+            args = message["input"]
+            tool_invocation_reply = (
+                f"\n\n🔧 Claude is calling: `{tool}` with arguments:\n```json\n{json.dumps(args, indent=2)}\n```"
+            )
+            return ToolCall(tool, args, assistant_reply, tool_invocation_reply)
+
+    return None
+
+def final_text(content):
+    """The last text block of a reply without tool calls, or "" if it has none."""
+    texts = [message["text"] for message in content if message["type"] == "text"]
+    return texts[-1] if texts else ""
+
+def run_tool_call(chat: ChatSession, tool_call):
+    """Execute a tool call and record it in the chat. Returns the follow-up request's tool_prompt."""
+    logger.info(f"\n🔧 Claude is calling: {tool_call.name} with arguments: {json.dumps(tool_call.args)}")
+    payload = execute_tool(chat, tool_call.name, tool_call.args)
+    tool_result_message = tool_result_event(tool_call.name, payload)
+
+    chat.add("assistant", tool_call.reply)
+    chat.add("user", tool_result_message)
+    return tool_result_message if tool_call.real else ""
+
+def build_request(chat: ChatSession, include_tools=False, tool_prompt = ""):
+    """Build the Bedrock request kwargs for the current conversation state."""
     tools_available = chat.next_tools()
     tool_names = [tool["name"] for tool in tools_available]
 
     tools_available_prompt = f"\n\n📋 Available tools for use: {', '.join(tool_names) or 'None'}"
 
+    # Only the CURRENT STATE tail changes per turn; the static prefix is reused as-is
     separator = "\n----------\n"
-    enhanced_system_prompt = SYSTEM_PROMPT + separator + "CURRENT STATE:\n" + tools_available_prompt + "\n" + tool_prompt + separator
+    current_state = separator + "CURRENT STATE:\n" + tools_available_prompt + "\n" + tool_prompt + separator
 
+    messages = chat.context_messages()
     payload = {
         "anthropic_version": "bedrock-2023-05-31",
-        "system": enhanced_system_prompt,
-        "messages": chat.messages,
+        "system": [STATIC_SYSTEM_BLOCK, {"type": "text", "text": current_state}],
+        "messages": messages,
         "max_tokens":  5000
     }
 
     if include_tools and tools_available:
-        payload["tools"] = tools_available
+        payload["tools"] = static_tools(tuple(tool_names))
         payload["tool_choice"] = {"type": "auto"}
-    
-    body = {
-        "modelId": MODEL_ID,
-        "contentType": "application/json",
-        "accept": "application/json",
-        "body": json.dumps(payload)
-    }
 
     '''logger.info("Sending messages to Claude:")
     for m in chat.messages:
         logger.info(f" - {m['role']}: {m['content'][:60]}")'''
 
-    for attempt in range(max_retries + 1):
-        try:
-            logger.info(f"FINAL PAYLOAD: {json.dumps(payload, indent=2)}")
-            response = bedrock.invoke_model(**body)
-            response_body = json.loads(response["body"].read())
-            break # Success - exit the loop
-        except ClientError as e:
-            error_code = e.response['Error']['Code']
-            if error_code == 'ThrottlingException':
-                if attempt < max_retries:
-                    wait_time = 2 ** attempt
-                    logger.warning(f"Throttling detected. Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    logger.error("Max retries exceed for throttling")
-                    return "🤖 Sorry, I'm currently experiencing high demand. Please try again."
-            else:
-                logger.error(f"Bedrock API error {e}")
-                return "🤖 Sorry, I experienced an error. Please try again."
-
-    assistant_reply = ""
-
-    for message in response_body.get("content", []):
-        if message["type"] == "text":
-            assistant_reply = message["text"]
-
-            # Check for fake tool calls
-            if "🔧 Claude is calling:" in assistant_reply:
-                tool_name, fake_args = parse_fake_tool_call(assistant_reply)
-
-                if tool_name and fake_args:
-                    logger.info(f"Executing fake tool call: {tool_name} with {fake_args}")
-
-                    if tool_name == "update_dive_information":
-                        tool_result = update_dive_information(chat, **fake_args)
-                    else:
-                        logger.warning(f"Unknown fake tool call: {tool_name}")
-                        tool_result = {"error": f"Unknown tool: {tool_name}"}
-
-                    outcome = "failed" if tool_result.get("error") else "succeeded"
-                    tool_result_message = f"[SYSTEM_EVENT] Tool `{tool_name}` {outcome}: {json.dumps(tool_result)}"
-
-                    chat.add("assistant", assistant_reply)
-                    chat.add("user", tool_result_message)
-                    
-                    follow_up = invoke_claude(chat, include_tools=False)
-                    return assistant_reply + "\n\n" + follow_up
-            
-        elif message["type"] == "tool_use":
-            tool = message["name"]
-            args = message["input"]
-            
-            logger.info(f"\n🔧 Claude is calling: {tool} with arguments: {json.dumps(args)}")
+    logger.info(
+        f"Sending {len(messages)} of {len(chat.messages)} messages to Claude "
+        f"(~{chat.context_tokens()} message tokens, {len(chat.summary_lines)} summary lines)"
+    )
+    payload_json = json.dumps(payload)
+    # Only the tail, where the newest messages are, is worth reading in the logs
+    logger.debug(f"FINAL PAYLOAD (tail): ...{payload_json[-MAX_LOGGED_PAYLOAD_CHARS:]}")
 
-            tool_invocation_reply = (
-                f"\n\n🔧 Claude is calling: `{tool}` with arguments:\n```json\n{json.dumps(args, indent=2)}\n```"
-            )
-
-            if tool == "update_dive_information":
-                payload = update_dive_information(chat,**args)
-            
-            else:
-                logger.warning(f"Claude called an unknown tool: {tool}")
-                payload = {"error": f"Unknown tool: {tool}"}
-            
-            outcome = "failed" if payload.get("error") else "succeeded"
-            tool_result_message = f"[SYSTEM_EVENT] Tool `{tool}` {outcome}: {json.dumps(payload)}"
+    return {
+        "modelId": MODEL_ID,
+        "contentType": "application/json",
+        "accept": "application/json",
+        "body": payload_json
+    }
 
-            combined_reply = assistant_reply + tool_invocation_reply
-            chat.add("assistant", combined_reply)
+def tool_result_event(tool, result):
+    outcome = "failed" if result.get("error") else "succeeded"
+    return f"[SYSTEM_EVENT] Tool `{tool}` {outcome}: {json.dumps(result)}"
+
+def bedrock_error_reply(error: ClientError, attempt, max_retries):
+    """Retry policy shared by the sync and async agents: None to retry the call, else the apology to return."""
+    if error.response['Error']['Code'] == 'ThrottlingException':
+        if attempt < max_retries:
+            # Drain the shared bucket so every session backs off, then queue for a new token
+            bedrock_limiter.penalize()
+            logger.warning("Throttling detected. Waiting for the rate limiter before retrying...")
+            return None
+        logger.error("Max retries exceed for throttling")
+        return BUSY_REPLY
+    logger.error(f"Bedrock API error {error}")
+    return ERROR_REPLY
+
+def call_bedrock(method, body, max_retries = 4, client_id = "default"):
+    """Call a Bedrock runtime method once the shared rate limiter grants a token.
+
+    Returns (response, None) on success or (None, apology) once retries run out.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            bedrock_limiter.acquire(client_id, timeout=config.RATE_LIMIT_TIMEOUT)
+        except TimeoutError as e:
+            logger.error(str(e))
+            return None, BUSY_REPLY
 
-            chat.add("user", tool_result_message)
-            follow_up = invoke_claude(chat, include_tools=False, tool_prompt=tool_result_message)
-            
-            return combined_reply + "\n\n" + follow_up
+        try:
+            return method(**body), None
+        except ClientError as e:
+            error_reply = bedrock_error_reply(e, attempt, max_retries)
+            if error_reply:
+                return None, error_reply
 
+def invoke_claude(chat: ChatSession, include_tools=False, tool_prompt = "", max_retries = 4):
+    body = build_request(chat, include_tools, tool_prompt)
+
+    start_time = time.time()
+    response, error_reply = call_bedrock(bedrock.invoke_model, body, max_retries, chat.id)
+    if error_reply:
+        return error_reply
+    response_body = json.loads(response["body"].read())
+    logger.info(f"⏱️ Claude replied in {time.time() - start_time:.2f}s")
+    log_token_usage(response_body.get("usage"))
+
+    content = response_body.get("content", [])
+    tool_call = find_tool_call(content)
+    if tool_call:
+        tool_prompt = run_tool_call(chat, tool_call)
+        follow_up = invoke_claude(chat, include_tools=False, tool_prompt=tool_prompt)
+        return tool_call.reply + "\n\n" + follow_up
+
+    assistant_reply = final_text(content)
     if assistant_reply:
         chat.add("assistant", assistant_reply)
         return assistant_reply
     else:
-        return "🤖 Sorry, I didn’t catch that."
-    
+        return EMPTY_REPLY
+
+# --- Streaming ---
+def stream_content_blocks(response, start_time):
+    """Yield text deltas from a response stream, then return the assembled content blocks.
+
+    Tool-use input arrives as partial JSON fragments, which are concatenated per block
+    and parsed once the block closes.
+    """
+    blocks = {}
+    first_token_at = None
+
+    for event in response["body"]:
+        if "chunk" not in event:
+            # Mid-stream errors (throttling, validation, ...) arrive as their own event
+            raise RuntimeError(f"Bedrock stream error: {event}")
+        chunk = json.loads(event["chunk"]["bytes"])
+        chunk_type = chunk["type"]
+
+        if chunk_type == "message_start":
+            log_token_usage(chunk["message"].get("usage"))
+
+        elif chunk_type == "content_block_start":
+            block = dict(chunk["content_block"])
+            if block["type"] == "tool_use":
+                block["partial_json"] = ""
+            blocks[chunk["index"]] = block
+
+        elif chunk_type == "content_block_delta":
+            block = blocks[chunk["index"]]
+            delta = chunk["delta"]
+            if delta["type"] == "text_delta":
+                if first_token_at is None:
+                    first_token_at = time.time()
+                    logger.info(f"⏱️ Time to first token: {first_token_at - start_time:.2f}s")
+                block["text"] = block.get("text", "") + delta["text"]
+                yield delta["text"]
+            elif delta["type"] == "input_json_delta":
+                block["partial_json"] += delta["partial_json"]
+
+        elif chunk_type == "content_block_stop":
+            block = blocks[chunk["index"]]
+            if block["type"] == "tool_use":
+                partial_json = block.pop("partial_json")
+                block["input"] = json.loads(partial_json) if partial_json else {}
+
+    logger.info(f"⏱️ Claude finished streaming in {time.time() - start_time:.2f}s")
+    return [blocks[index] for index in sorted(blocks)]
+
+def invoke_claude_stream(chat: ChatSession, include_tools=False, tool_prompt = "", max_retries = 4):
+    """Streaming counterpart of invoke_claude: yields reply text as Claude generates it."""
+    body = build_request(chat, include_tools, tool_prompt)
+
+    start_time = time.time()
+    response, error_reply = call_bedrock(bedrock.invoke_model_with_response_stream, body, max_retries, chat.id)
+    if error_reply:
+        yield error_reply
+        return
+
+    try:
+        content = yield from stream_content_blocks(response, start_time)
+    except Exception as e:
+        logger.error(f"Bedrock stream failed: {e}")
+        yield ERROR_REPLY
+        return
+
+    tool_call = find_tool_call(content)
+    if tool_call:
+        # The text has already been streamed; only the notice for a real tool_use is new
+        if tool_call.notice:
+            yield tool_call.notice
+        tool_prompt = run_tool_call(chat, tool_call)
+
+        yield "\n\n"
+        yield from invoke_claude_stream(chat, include_tools=False, tool_prompt=tool_prompt)
+        return
+
+    assistant_reply = final_text(content)
+    if assistant_reply:
+        chat.add("assistant", assistant_reply)
+    else:
+        yield EMPTY_REPLY
+
+def continue_chat_stream(chat: ChatSession, user_input):
+    """Like continue_chat, but yields the reply as it streams in (for st.write_stream)."""
+    chat.add("user", user_input)
+    has_tools = bool(chat.next_tools())
+    yield from invoke_claude_stream(chat, include_tools=has_tools)
+
 
 if __name__ == "__main__":
     logger.info("🎬 Dive Agent Started – Type 'exit' to quit\n")
-    chat = ChatSession(available_tools=[UPDATE_DIVE_INFORMATION_TOOL])
+    chat = ChatSession(available_tools=ALL_TOOLS)
     start_chat(chat)
 
     while True:
@@ -340,4 +560,6 @@ if __name__ == "__main__":
         if user_reply.strip().lower() in ["exit", "quit"]:
             logger.info("Exiting session.")
             break
-        continue_chat(chat, user_reply)
\ No newline at end of file
+        continue_chat(chat, user_reply)
+
+    metadata_store.close()
\ No newline at end of file
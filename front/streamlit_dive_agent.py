@@ -1,4 +1,5 @@
 import hashlib
+import itertools
 import logging
 import os
 import sys
@@ -12,8 +13,8 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "s
 
 from chat_session import ChatSession
 from config import config
-from dive_agent_bedrock import start_chat, continue_chat, ALL_TOOLS
-from utils import load_json_from_s3
+from dive_agent_bedrock import start_chat, continue_chat, continue_chat_stream, ALL_TOOLS, bedrock_limiter
+from utils import generate_presigned_url, load_json_from_s3, load_status
 
 # Initialise clients and logger
 s3 = boto3.client("s3")
@@ -81,6 +82,40 @@ if "chat_started" not in st.session_state:
     st.session_state["chat_started"] = True
     first_reply = start_chat(chat)
     
+PROCESSING_TIMEOUT = 240
+STATUS_POLL_SECONDS = 3
+
+@st.fragment(run_every=STATUS_POLL_SECONDS)
+def processing_status():
+    """Show pipeline progress for the uploaded video, re-running on its own without blocking the app."""
+    session_id = st.session_state.get("processing_session_id")
+    if not session_id:
+        return
+
+    status = load_status(session_id)
+    # Ignore a status left behind by an earlier run on the same video
+    if status and status["updated_at"] < st.session_state["processing_started_at"]:
+        status = None
+    stage = status["stage"] if status else None
+
+    if stage == "complete":
+        # The video has been processed by the pipeline, so load its metadata into the chat session
+        chat.current_dive = load_json_from_s3(status["metadata_key"])
+        #chat.metadata_done = has_complete_metadata(chat.current_dive)
+        del st.session_state["processing_session_id"]
+        st.session_state["processing_done"] = session_id
+        st.rerun()
+    elif stage == "failed":
+        del st.session_state["processing_session_id"]
+        st.error(f"❌ The pipeline failed to process the video: {status.get('error')}")
+    elif time.time() - st.session_state["processing_started_at"] > PROCESSING_TIMEOUT:
+        del st.session_state["processing_session_id"]
+        st.error("⏳ Timed out waiting to retrieve the session metadata. Re-check that the video has been processed by the pipeline.")
+    elif status:
+        st.progress(status["progress"], text=f"Processing your dive video: {stage.replace('_', ' ')}...")
+    else:
+        st.info("⏳ Waiting for the pipeline to pick up your video...")
+
 # Left sidebar [Top section]: Video Upload
 with st.sidebar:
     st.subheader("Upload a dive video!")
@@ -90,6 +125,7 @@ with st.sidebar:
     if uploaded_file and uploaded_file.name != st.session_state.get("last_uploaded_filename"):
         with st.spinner("Uploading and processing your dive video..."):
             raw_s3_key = f"raw/{uploaded_file.name}"
+            upload_started_at = time.time()
             s3.upload_fileobj(uploaded_file, config.BUCKET_NAME, raw_s3_key)
             st.success(f"✅ Video {uploaded_file.name} has been successfully uploaded!")
 
@@ -107,41 +143,26 @@ with st.sidebar:
 
             st.session_state["last_uploaded_filename"] = uploaded_file.name
             
-            processed_prefix = f"processed/{session_id}"
-            timeout = 120
-            start_time = time.time()
-            metadata_key = None
-
-            time.sleep(15)
-            while time.time() - start_time < timeout:
-                result = s3.list_objects_v2(Bucket=config.BUCKET_NAME, Prefix=processed_prefix)
-                for obj in result.get("Contents", []):
-                    if obj["Key"].endswith("session_metadata.json"):
-                        metadata_key = obj["Key"]
-                        break
-                if metadata_key:
-                    break
-                time.sleep(3)
-
-            # If the metadata is available (i.e., the video has been processed by the pipeline), load it into the chat session.
-            if metadata_key:
-                chat.current_dive = load_json_from_s3(metadata_key)
-                #chat.metadata_done = has_complete_metadata(chat.current_dive)
-                st.success("✅ The dive video has been processed.")
-            else:
-                st.error("⏳ Timed out waiting to retrieve the session metadata. Re-check that the video has been processed by the pipeline.")
+            # The pipeline reports its progress in a status object that the fragment below watches
+            st.session_state["processing_session_id"] = session_id
+            st.session_state["processing_started_at"] = upload_started_at
+
+    processing_status()
+    if st.session_state.get("processing_done") == chat.dive_session_id:
+        st.success("✅ The dive video has been processed.")
 
     # Left sidebar [Bottom section]: Video Preview
     st.markdown("---")
     st.subheader("Video Preview")
-    if uploaded_file is not None: 
-        # Generate a presigned URL for the S3 video so that it can be previewed in the browser
-        url = s3.generate_presigned_url(
-            "get_object",
-            Params={"Bucket": config.BUCKET_NAME, "Key": f"raw/{uploaded_file.name}"},
-            ExpiresIn=3600,
-        )
-        st.video(url)
+    # Preview the pipeline's low-res proxy when there is one, otherwise stream the raw upload
+    preview_key = chat.current_dive.get("preview_key")
+    thumbnails_key = chat.current_dive.get("thumbnails_key")
+    if preview_key:
+        st.video(generate_presigned_url(config.BUCKET_NAME, preview_key))
+    elif uploaded_file is not None:
+        st.video(generate_presigned_url(config.BUCKET_NAME, f"raw/{uploaded_file.name}"))
+    if thumbnails_key:
+        st.image(generate_presigned_url(config.BUCKET_NAME, thumbnails_key), caption="Clip overview")
 
 # Chat interface
 st.title("🤿 Dive Agent")
@@ -165,10 +186,9 @@ user_input = st.chat_input("Talk to Dive Buddy Claude.")
 
 if user_input:
     st.chat_message("user").write(f"**You:** {user_input}")
-    # After the user input, continue the chat session with Claude
-    assistant_reply = continue_chat(chat, user_input)
+    # After the user input, continue the chat session with Claude, streaming the reply as it arrives
     with st.chat_message("assistant"):
-        st.write(f"**Dive Buddy Claude:** {assistant_reply}")
+        st.write_stream(itertools.chain(["**Dive Buddy Claude:** "], continue_chat_stream(chat, user_input)))
 
 # Debug section to help with dev
 with st.expander("🔍 Debug"):
@@ -179,5 +199,6 @@ with st.expander("🔍 Debug"):
         "current_dive": chat.current_dive,
         "next_tools": chat.next_tools(),
         "last_uploaded_filename": st.session_state.get("last_uploaded_filename"),
+        "rate_limiter": bedrock_limiter.metrics(),
         "messages": [f"{message['role']}: {message['content'][:60]}..." for message in chat.messages]
     })
\ No newline at end of file
@@ -3,10 +3,13 @@ import logging
 import re
 from openai import OpenAI
 from config import config
+from rate_limiter import get_limiter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+OPENAI_MODEL = "gpt-4.1-mini"
+
 def get_openai_client():
     return OpenAI(api_key=config.get_openai_api_key())
 
@@ -22,6 +25,50 @@ def build_image_input(image_urls, prompt_text):
         })
     return content
 
+# Appended to the single-clip system prompt, whose output rules ask for one plain <BEGIN_JSON> block
+BATCH_OUTPUT_OVERRIDE = """
+BATCH MODE: this request covers several clips of the same dive, and the rules below replace the output instructions above.
+Analyse each clip separately, exactly as you would a single video, and only use a clip's own frames for its answer.
+Return one JSON object per clip, in the format described above, each wrapped in its own markers carrying the clip ID:
+<BEGIN_JSON clip="CLIP_ID">
+{ ... }
+<END_JSON>
+
+Respond only with these JSON blocks, one for every clip ID you are given."""
+
+def build_batch_system_prompt(system_prompt):
+    return f"{system_prompt}\n{BATCH_OUTPUT_OVERRIDE}"
+
+def build_batch_image_input(clips, prompt_text):
+    """Image input for several clips of one dive, each in its own labelled section."""
+    clip_ids = ", ".join(f'"{clip_id}"' for clip_id in clips)
+    instructions = (
+        f"{prompt_text}\n\n"
+        f"These frames come from {len(clips)} clips of the same dive, labelled by clip ID below.\n"
+        f"Clip IDs: {clip_ids}"
+    )
+    content = [{"type": "input_text", "text": instructions}]
+    for clip_id, image_urls in clips.items():
+        content.extend(build_image_input(image_urls, f'Clip "{clip_id}".'))
+    return content
+
+def parse_batch_output(full_output, clip_ids):
+    """Map clip IDs to their validated JSON from a batched reply, skipping any that are missing or invalid."""
+    blocks = re.findall(r'<BEGIN_JSON clip="([^"]+)">(.*?)<END_JSON>', full_output, re.DOTALL)
+    if not blocks and len(clip_ids) == 1:
+        # A lone clip answered with the single-clip marker is still unambiguous
+        blocks = [(clip_ids[0], json_str) for json_str in re.findall(r'<BEGIN_JSON>(.*?)<END_JSON>', full_output, re.DOTALL)]
+
+    results = {}
+    for clip_id, json_str in blocks:
+        if clip_id not in clip_ids or clip_id in results:
+            continue
+        try:
+            results[clip_id] = {"json_only": json.dumps(json.loads(json_str.strip()), indent=2)}
+        except json.JSONDecodeError as e:
+            logger.warning(f"Invalid JSON for clip {clip_id} in batched GPT response: {e}")
+    return results
+
 def load_system_prompt():
     """ Load system prompt from S3 for Lambda compatbility"""
     try:
@@ -42,8 +89,10 @@ def analyse_with_gpt(image_urls, system_prompt):
             {"role": "user", "content": build_image_input(image_urls, prompt_text)}
         ]
 
+        # Wait for the process-wide OpenAI quota rather than getting rate limited
+        get_limiter(OPENAI_MODEL, config.OPENAI_RPM).acquire(timeout=config.RATE_LIMIT_TIMEOUT)
         response = client.responses.create(
-            model="gpt-4.1-mini",
+            model=OPENAI_MODEL,
             input=messages
         )
         full_output = response.output_text
@@ -67,6 +116,46 @@ def analyse_with_gpt(image_urls, system_prompt):
         logger.error(f"Error in GPT analysis: {str(e)}")
         raise
 
+def analyse_clips_with_gpt(clips, system_prompt):
+    """Analyse several clips of one dive in a single request.
+
+    clips maps a clip ID (the session ID) to its frame URLs. Returns the same shape as
+    analyse_with_gpt for each clip ID, so the system prompt and request overhead are
+    paid once per dive instead of once per clip. Clips the batched reply doesn't answer
+    are analysed on their own with analyse_with_gpt.
+    """
+    logger.debug(f"Analysing {len(clips)} clips with GPT: {list(clips)}")
+    results = {}
+    try:
+        client = get_openai_client()
+        prompt_text = "Here are several cropped frames from a few short dive videos."
+
+        messages = [
+            {"role": "system", "content": build_batch_system_prompt(system_prompt)},
+            {"role": "user", "content": build_batch_image_input(clips, prompt_text)}
+        ]
+
+        get_limiter(OPENAI_MODEL, config.OPENAI_RPM).acquire(timeout=config.RATE_LIMIT_TIMEOUT)
+        response = client.responses.create(
+            model=OPENAI_MODEL,
+            input=messages
+        )
+        full_output = response.output_text
+        logger.info(f"GPT response: {full_output}")
+
+        results = parse_batch_output(full_output, list(clips))
+
+    except Exception as e:
+        logger.error(f"Error in batched GPT analysis: {str(e)}")
+
+    missing = [clip_id for clip_id in clips if clip_id not in results]
+    if missing:
+        logger.warning(f"Batched GPT response had no result for clips {', '.join(missing)}, analysing them one by one")
+        for clip_id in missing:
+            results[clip_id] = analyse_with_gpt(clips[clip_id], system_prompt)
+
+    return results
+
 if __name__ == "__main__":
     system_prompt = load_system_prompt()
     gpt_result = analyse_with_gpt(image_urls, system_prompt)
@@ -13,7 +13,27 @@ class Config:
     SECRET_NAME = os.environ.get('SECRET_NAME', 'dive-analysis-openai-key')
     MAX_FRAMES = int(os.environ.get('MAX_FRAMES', '3'))
     KNOWLEDGE_BASE_TABLE = os.environ.get('KNOWLEDGE_BASE_TABLE', 'dive-knowledge-base')
+    KB_MANIFEST_KEY = os.environ.get('KB_MANIFEST_KEY', 'knowledge_base/manifest.json')
+    KB_FETCH_WORKERS = int(os.environ.get('KB_FETCH_WORKERS', '16'))
+    KB_INDEX_KEY = os.environ.get('KB_INDEX_KEY', 'knowledge_base/index.json.gz')
+    KB_INDEX_TTL = int(os.environ.get('KB_INDEX_TTL', '300'))
+    KB_SNAPSHOT_KEY = os.environ.get('KB_SNAPSHOT_KEY', 'knowledge_base/species_snapshot.tar.gz')
     FRAME_INTERVAL = int(os.environ.get('FRAME_INTERVAL', '3'))
+    SHARPNESS_WEIGHT = float(os.environ.get('SHARPNESS_WEIGHT', '0.7'))
+    SALIENCY_WEIGHT = float(os.environ.get('SALIENCY_WEIGHT', '0.3'))
+    ANYTIME_COARSE_SAMPLES = int(os.environ.get('ANYTIME_COARSE_SAMPLES', '32'))
+    DEADLINE_RESERVE_SECONDS = int(os.environ.get('DEADLINE_RESERVE_SECONDS', '45'))
+    MOTION_THUMB_WIDTH = int(os.environ.get('MOTION_THUMB_WIDTH', '64'))
+    MOTION_PIXEL_DELTA = int(os.environ.get('MOTION_PIXEL_DELTA', '12'))
+    MOTION_THRESHOLD = float(os.environ.get('MOTION_THRESHOLD', '0.001'))
+    PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', '480'))
+    PREVIEW_FPS = int(os.environ.get('PREVIEW_FPS', '15'))
+    FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+    THUMBNAIL_COUNT = int(os.environ.get('THUMBNAIL_COUNT', '16'))
+    THUMBNAIL_WIDTH = int(os.environ.get('THUMBNAIL_WIDTH', '160'))
+    BEDROCK_RPM = int(os.environ.get('BEDROCK_RPM', '50'))
+    OPENAI_RPM = int(os.environ.get('OPENAI_RPM', '500'))
+    RATE_LIMIT_TIMEOUT = int(os.environ.get('RATE_LIMIT_TIMEOUT', '60'))
     TEMP_DIR = '/tmp'
 
     @classmethod
@@ -1,7 +1,13 @@
+import bisect
+import heapq
+import math
 import os
+import time
 import cv2
+import numpy as np
 import tempfile
 import shutil
+import subprocess
 import logging
 from config import config
 from utils import generate_presigned_url
@@ -9,41 +15,367 @@ from utils import generate_presigned_url
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def extract_frames(video_path, s3_client, s3_prefix, max_frames, frame_interval):
+def find_ffmpeg():
+    """Path of the ffmpeg binary used for preview proxies, or None if there isn't one."""
+    return shutil.which(config.FFMPEG_PATH)
 
+class PreviewBuilder:
+    """Builds a low-resolution H.264 preview proxy (with ffmpeg, alongside scoring) and a
+    thumbnail sprite sheet fed from extract_frames' decode pass."""
+
+    def __init__(self, temp_dir, fps, total_frames, frame_size, thumb_indices=None):
+        width, height = frame_size
+        self.proxy = None
+        self.proxy_path = os.path.join(temp_dir, "preview.mp4")
+
+        thumb_width = config.THUMBNAIL_WIDTH
+        self.thumb_size = (thumb_width, int(height * thumb_width / width) // 2 * 2)
+        count = config.THUMBNAIL_COUNT
+        if thumb_indices is not None:
+            self.thumb_indices = set(thumb_indices)
+        elif total_frames > 0:
+            self.thumb_indices = {int(i * total_frames / count) for i in range(count)}
+        else:
+            # Unknown length: one thumbnail every two seconds, up to the limit
+            self.thumb_indices = {int(i * fps * 2) for i in range(count)}
+        self.thumbnails = []
+        self.sprite_path = os.path.join(temp_dir, "thumbnails.jpg")
+
+    def start_proxy(self, video_path):
+        """Start transcoding the proxy in the background. Returns False if ffmpeg isn't available."""
+        ffmpeg = find_ffmpeg()
+        if ffmpeg is None:
+            logger.warning(f"{config.FFMPEG_PATH} not found, skipping the preview proxy")
+            return False
+
+        self.proxy = subprocess.Popen([
+            ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", video_path,
+            # Drop frames before scaling; never upscale, and keep dimensions even for libx264
+            "-vf", f"fps={config.PREVIEW_FPS},scale='min({config.PREVIEW_WIDTH},iw)':-2",
+            "-an", "-c:v", "libx264", "-preset", "ultrafast", "-crf", "30", "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart", self.proxy_path
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return True
+
+    def add_thumbnail(self, frame, frame_index):
+        if frame_index in self.thumb_indices:
+            self.thumbnails.append(cv2.resize(frame, self.thumb_size, interpolation=cv2.INTER_AREA))
+
+    def finish_proxy(self, deadline=None):
+        """Wait for the proxy, at most until the deadline. Returns True if it was written."""
+        if self.proxy is None:
+            return False
+
+        timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+        try:
+            _, stderr = self.proxy.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proxy.kill()
+            self.proxy.communicate()
+            logger.warning("Preview proxy didn't finish before the deadline, skipping it")
+            return False
+
+        if self.proxy.returncode != 0:
+            logger.warning(f"ffmpeg failed to write the preview proxy: {stderr.decode(errors='replace').strip()[-500:]}")
+            return False
+        return True
+
+    def upload(self, s3_client, s3_prefix, deadline=None):
+        """Finish both outputs, upload them and return their keys."""
+        uploaded = {}
+        if self.finish_proxy(deadline):
+            key = f"{s3_prefix}/preview.mp4"
+            s3_client.upload_file(self.proxy_path, config.BUCKET_NAME, key, ExtraArgs={"ContentType": "video/mp4"})
+            logger.info(f"Uploaded preview proxy to s3://{config.BUCKET_NAME}/{key}")
+            uploaded["preview_key"] = key
+
+        if self.thumbnails:
+            columns = math.ceil(math.sqrt(len(self.thumbnails)))
+            blank = np.zeros_like(self.thumbnails[0])
+            tiles = self.thumbnails + [blank] * (-len(self.thumbnails) % columns)
+            rows = [np.hstack(tiles[i:i + columns]) for i in range(0, len(tiles), columns)]
+            cv2.imwrite(self.sprite_path, np.vstack(rows), [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+            key = f"{s3_prefix}/thumbnails.jpg"
+            s3_client.upload_file(self.sprite_path, config.BUCKET_NAME, key, ExtraArgs={"ContentType": "image/jpeg"})
+            logger.info(f"Uploaded {len(self.thumbnails)}-frame thumbnail sprite to s3://{config.BUCKET_NAME}/{key}")
+            uploaded["thumbnails_key"] = key
+        return uploaded
+
+    def close(self):
+        """Stop the proxy transcode if it is still running (e.g. extraction failed)."""
+        if self.proxy is not None and self.proxy.poll() is None:
+            self.proxy.kill()
+            self.proxy.communicate()
+
+# One record per candidate, persisted as processed/<session_id>/frame_scores.npy so frames
+# can be re-selected without decoding the video again (see reselect_frames.py).
+# Candidates pruned by the motion filter share their representative's scores.
+SCORE_INDEX_DTYPE = np.dtype([
+    ("frame_idx", "<i4"),
+    ("timestamp", "<f4"),
+    ("sharpness", "<f4"),
+    ("saliency", "<f4"),
+    ("phash", "<u8"),
+    ("representative", "<i4"),
+])
+
+def tiny_gray(frame, width):
+    """Small grayscale copy of a frame for cheap comparisons."""
+    height, frame_width = frame.shape[:2]
+    size = (width, max(1, round(height * width / frame_width)))
+    # Subsample first so INTER_AREA only averages a few pixels per output pixel
+    step = max(1, frame_width // (width * 4))
+    return cv2.cvtColor(cv2.resize(frame[::step, ::step], size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+def perceptual_hash(gray):
+    """64-bit DCT perceptual hash of a grayscale image."""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return int(np.packbits(low > np.median(low)).view(">u8")[0])
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class MotionFilter:
+    """Cheap change detector in front of the expensive scorer: a candidate that barely differs
+    from the nearest scored representative on either side joins its segment and is skipped."""
+
+    def __init__(self, threshold, pixel_delta):
+        self.threshold = threshold
+        self.pixel_delta = pixel_delta
+        self.positions = []
+        self.thumbs = {}
+        self.pruned = 0
+
+    def changed(self, thumb, other):
+        return np.count_nonzero(cv2.absdiff(thumb, other) > self.pixel_delta) > self.threshold * thumb.size
+
+    def representative(self, thumb, frame_index):
+        """Frame index of the segment this candidate belongs to; its own index if it starts a new one."""
+        i = bisect.bisect_left(self.positions, frame_index)
+        for neighbour in self.positions[max(0, i - 1):i + 1]:
+            if not self.changed(thumb, self.thumbs[neighbour]):
+                self.pruned += 1
+                return neighbour
+
+        self.positions.insert(i, frame_index)
+        self.thumbs[frame_index] = thumb
+        return frame_index
+
+    @property
+    def segments(self):
+        return len(self.positions)
+
+def frame_scores(frame, saliency_detector):
+    """Return (sharpness, saliency) for a frame."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
+    success, saliency = saliency_detector.computeSaliency(frame)
+    saliency_score = saliency.mean() if success else 0
+    return sharpness, saliency_score
+
+def combine_scores(sharpness, saliency, sharpness_weight=config.SHARPNESS_WEIGHT, saliency_weight=config.SALIENCY_WEIGHT):
+    """Combined frame score. Works on scalars and on score index columns alike."""
+    return (sharpness * sharpness_weight) + (saliency * 100 * saliency_weight)
+
+def score_frame(frame, saliency_detector):
+    return combine_scores(*frame_scores(frame, saliency_detector))
+
+def keep_best(best, max_frames, score, frame, frame_index):
+    """Keep the top max_frames (score, frame_index, frame) entries in a min-heap."""
+    entry = (score, frame_index, frame.copy())
+    if len(best) < max_frames:
+        heapq.heappush(best, entry)
+    elif score > best[0][0]:
+        heapq.heapreplace(best, entry)
+
+class FrameScorer:
+    """Scores candidate frames, keeps the best max_frames in memory and records every
+    candidate for the score index."""
+
+    def __init__(self, max_frames, fps, motion_filter=None):
+        self.max_frames = max_frames
+        self.fps = fps
+        self.motion_filter = motion_filter
+        self.saliency_detector = cv2.saliency.StaticSaliencySpectralResidual_create()
+        self.best = []
+        # Pruned candidates, to top up with when there are fewer segments than max_frames
+        self.fallback = []
+        self.rows = []
+        self.scores = {}
+
+    @property
+    def considered(self):
+        return len(self.rows)
+
+    def consider(self, frame, frame_index):
+        thumb = tiny_gray(frame, config.MOTION_THUMB_WIDTH)
+        representative = frame_index
+        if self.motion_filter:
+            representative = self.motion_filter.representative(thumb, frame_index)
+
+        if representative == frame_index:
+            sharpness, saliency = frame_scores(frame, self.saliency_detector)
+            self.scores[frame_index] = (sharpness, saliency)
+            keep_best(self.best, self.max_frames, combine_scores(sharpness, saliency), frame, frame_index)
+        else:
+            sharpness, saliency = self.scores[representative]
+            if len(self.best) < self.max_frames:
+                keep_best(self.fallback, self.max_frames, combine_scores(sharpness, saliency), frame, frame_index)
+
+        self.rows.append((frame_index, frame_index / self.fps, sharpness, saliency, perceptual_hash(thumb), representative))
+
+    def best_frames(self):
+        """(score, frame_index, frame) for the winners, best first."""
+        top_up = heapq.nlargest(self.max_frames - len(self.best), self.fallback, key = lambda x: x[0])
+        return sorted(self.best, key = lambda x: x[0], reverse = True) + top_up
+
+    def score_index(self):
+        return np.sort(np.array(self.rows, dtype=SCORE_INDEX_DTYPE), order="frame_idx")
+
+def coarse_step(candidates, coarse_samples):
+    """Largest power-of-two spacing that still gives at least coarse_samples coarse samples."""
+    step = 1
+    while math.ceil(candidates / (step * 2)) >= coarse_samples:
+        step *= 2
+    return step
+
+def out_of_time(deadline, sample_seconds):
+    return deadline is not None and time.monotonic() + sample_seconds > deadline
+
+def scan_sequential(cap, scorer, frame_interval, preview=None, deadline=None):
+    """Decode the whole video, passing every frame_interval-th frame to the scorer."""
+    frame_count = 0
+    sample_seconds = 0.0
+    last_sample = time.monotonic()
+
+    while True:
+        if scorer.considered >= scorer.max_frames and out_of_time(deadline, sample_seconds):
+            logger.warning(f"Deadline reached at frame {frame_count}, using the best of {scorer.considered} candidates so far")
+            break
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        if preview:
+            preview.add_thumbnail(frame, frame_count)
+
+        if frame_count % frame_interval == 0:
+            scorer.consider(frame, frame_count)
+            # Includes decoding the skipped frames since the last sample
+            now = time.monotonic()
+            sample_seconds, last_sample = now - last_sample, now
+
+        frame_count += 1
+
+def scan_anytime(cap, scorer, frame_interval, total_frames, step, deadline, preview=None):
+    """Pass every step-th candidate to the scorer, then fill in the rest in one forward pass,
+    stopping at the deadline. Returns the number of candidates."""
+    candidates = math.ceil(total_frames / frame_interval)
+    grab_limit = int(cap.get(cv2.CAP_PROP_FPS) or 30)
+    if step * frame_interval <= grab_limit:
+        # Coarse samples this close together are reached by decoding every frame anyway
+        scan_sequential(cap, scorer, frame_interval, preview, deadline)
+        return candidates
+
+    sample_seconds = 0.0
+    for j in range(0, candidates, step):
+        # Always look at enough frames to have something to send
+        if scorer.considered >= scorer.max_frames and out_of_time(deadline, sample_seconds):
+            logger.warning(f"Deadline reached in the coarse pass, using the best of {scorer.considered}/{candidates} candidates")
+            return candidates
+
+        start = time.monotonic()
+        cap.set(cv2.CAP_PROP_POS_FRAMES, j * frame_interval)
+        ret, frame = cap.read()
+        if not ret:
+            continue
+
+        if preview:
+            preview.add_thumbnail(frame, j * frame_interval)
+        scorer.consider(frame, j * frame_interval)
+        sample_seconds = time.monotonic() - start
+
+    # Decoding forward once is far cheaper than seeking to each remaining candidate
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    last_sample = time.monotonic()
+    for frame_count in range(total_frames):
+        if not cap.grab():
+            break
+        if frame_count % frame_interval or (frame_count // frame_interval) % step == 0:
+            continue
+
+        if out_of_time(deadline, sample_seconds):
+            logger.warning(f"Deadline reached at frame {frame_count}, using the best of {scorer.considered}/{candidates} candidates")
+            break
+        ret, frame = cap.retrieve()
+        if not ret:
+            continue
+
+        scorer.consider(frame, frame_count)
+        # Includes grabbing the frames since the last sample
+        now = time.monotonic()
+        sample_seconds, last_sample = now - last_sample, now
+
+    return candidates
+
+def extract_frames(video_path, s3_client, s3_prefix, max_frames, frame_interval, preview_prefix=None, deadline=None,
+                   prefilter=True, score_index_key=None):
+    """Upload the best-scoring frames and return (frame_urls, keys).
+
+    preview_prefix adds a preview proxy and thumbnail sprite, score_index_key the score
+    index; keys holds the keys of whichever were uploaded. With a deadline (a
+    time.monotonic() timestamp), frames are scored coarse-to-fine until it is near.
+    """
     temp_dir = None
+    preview = None
     try:
         temp_dir = tempfile.mkdtemp(dir='/tmp')
 
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             raise ValueError(f"Could not open video file: {video_path}")
-            
-        saliency_detector = cv2.saliency.StaticSaliencySpectralResidual_create()
-        frame_scores = []
-        frame_count = 0
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            if frame_count % frame_interval == 0:
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                sharpness = cv2.Laplacian(gray, cv2.CV_64F).var()
-                success, saliency = saliency_detector.computeSaliency(frame)
-                saliency_score = saliency.mean() if success else 0
-                combined_score = (sharpness * 0.7) + (saliency_score * 100 * 0.3)
-                frame_scores.append((combined_score, frame.copy(), frame_count))
-
-            frame_count += 1
+
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        # Seeking needs a known length; otherwise fall back to a sequential scan that stops at the deadline
+        anytime = deadline is not None and total_frames > 0
+
+        step = None
+        if anytime:
+            step = coarse_step(math.ceil(total_frames / frame_interval), config.ANYTIME_COARSE_SAMPLES)
+            if preview_prefix:
+                coarse = list(range(0, total_frames, step * frame_interval))
+                stride = math.ceil(len(coarse) / config.THUMBNAIL_COUNT)
+                preview = PreviewBuilder(temp_dir, fps, total_frames, frame_size, thumb_indices=coarse[::stride])
+        elif preview_prefix:
+            preview = PreviewBuilder(temp_dir, fps, total_frames, frame_size)
+        if preview:
+            preview.start_proxy(video_path)
+
+        motion_filter = None
+        if prefilter:
+            motion_filter = MotionFilter(config.MOTION_THRESHOLD, config.MOTION_PIXEL_DELTA)
+        scorer = FrameScorer(max_frames, fps, motion_filter)
+
+        if anytime:
+            candidates = scan_anytime(cap, scorer, frame_interval, total_frames, step, deadline, preview)
+            logger.info(f"Anytime extraction considered {scorer.considered}/{candidates} candidates, "
+                        f"{deadline - time.monotonic():.1f}s before the deadline")
+        else:
+            scan_sequential(cap, scorer, frame_interval, preview, deadline)
+
+        if motion_filter:
+            logger.info(f"Motion pre-filter scored {motion_filter.segments}/{scorer.considered} candidates, "
+                        f"pruned {motion_filter.pruned} as static")
 
         cap.release()
 
         saved_urls = []
-        best_frames = sorted(frame_scores, key = lambda x: x[0], reverse = True)[:max_frames]
-
-        for i, (_, frame, idx) in enumerate(best_frames):
+        for i, (_, idx, frame) in enumerate(scorer.best_frames()):
             filename = f"frame_{i+1}_at_{idx}.jpg"
             filepath = os.path.join(temp_dir, filename)
             key = f"{s3_prefix}/{filename}"
@@ -55,11 +387,23 @@ def extract_frames(video_path, s3_client, s3_prefix, max_frames, frame_interval)
 
             url = generate_presigned_url(config.BUCKET_NAME, key)
             saved_urls.append(url)
-        return saved_urls
+
+        keys = preview.upload(s3_client, preview_prefix, deadline) if preview else {}
+
+        if score_index_key:
+            index_path = os.path.join(temp_dir, "frame_scores.npy")
+            np.save(index_path, scorer.score_index())
+            s3_client.upload_file(index_path, config.BUCKET_NAME, score_index_key, ExtraArgs={"ContentType": "application/octet-stream"})
+            logger.info(f"Uploaded {scorer.considered}-frame score index to s3://{config.BUCKET_NAME}/{score_index_key}")
+            keys["score_index_key"] = score_index_key
+
+        return saved_urls, keys
     
     except Exception as e:
         logger.error(f"Error in frame extraction: {str(e)}")
         raise
     finally:
+        if preview:
+            preview.close()
         if temp_dir and os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
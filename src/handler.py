@@ -1,12 +1,20 @@
-from pipeline import run_pipeline
+from pipeline import run_pipeline, run_pipeline_batch
 import json
 import logging
+import time
 import urllib.parse
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+def deadline_from_context(context):
+    """time.monotonic() timestamp at which Lambda will time this invocation out, or None when run locally."""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000
+
 def lambda_handler(event, context):
+    deadline = deadline_from_context(context)
     
     logger.info(f"Lambda handler has been triggered with event: {json.dumps(event)} | Type: {type(event)}")
 
@@ -18,6 +26,21 @@ def lambda_handler(event, context):
         s3_key = urllib.parse.unquote_plus(s3_key)
         logger.debug(f"S3 key (after decoding): {s3_key}")
     
+    # Several clips of the same dive can be analysed together with a direct invocation
+    elif event.get('s3_keys'):
+        s3_keys = event['s3_keys']
+        logger.info(f"Processing {len(s3_keys)} clips as one dive: {s3_keys}")
+        session_ids = run_pipeline_batch(s3_keys, deadline)
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': 'The dive video analysis has been completed successfully.',
+                'session_ids': session_ids,
+                's3_keys': s3_keys
+            })
+        }
+
     # If the event is not an S3 event (i.e., direct invocation), extract the s3 key directly from the event
     else:
         s3_key = event.get('s3_key')
@@ -26,7 +49,7 @@ def lambda_handler(event, context):
         raise ValueError("s3_key was not provided in event.")
 
     logger.info(f"Processing S3 key: {s3_key}")
-    session_id = run_pipeline(s3_key)
+    session_id = run_pipeline(s3_key, deadline)
 
     return {
         'statusCode': 200,
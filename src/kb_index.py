@@ -0,0 +1,115 @@
+import bisect
+import gzip
+import json
+import logging
+import threading
+import time
+
+import boto3
+from config import config
+
+s3 = boto3.client("s3")
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_cache = {"index": None, "loaded_at": 0.0}
+_cache_lock = threading.Lock()
+
+def normalise(text):
+    """Lower-case and collapse whitespace so 'Reef  Manta' and 'reef manta' share a key."""
+    return " ".join(str(text).lower().split())
+
+def build_index(kb):
+    """Build inverted species/location/date lookups over the KB dives.
+
+    species maps a name to {dive_id: [session_id, ...]}, locations maps a location to
+    dive_ids, and dates is a sorted list of [dive_date, dive_id] for range queries.
+    """
+    index = {"dives": {}, "species": {}, "locations": {}, "dates": []}
+
+    for dive_id, dive in kb['dives'].items():
+        index["dives"][dive_id] = {
+            "dive_date": dive["dive_date"],
+            "dive_number": dive["dive_number"],
+            "dive_location": dive["dive_location"],
+            "sessions": dive["sessions"]
+        }
+        if dive["dive_location"]:
+            index["locations"].setdefault(normalise(dive["dive_location"]), []).append(dive_id)
+        index["dates"].append([dive["dive_date"], dive_id])
+
+        for species in dive["species_seen"]:
+            sessions = index["species"].setdefault(normalise(species["name"]), {}).setdefault(dive_id, [])
+            if species["session_id"] not in sessions:
+                sessions.append(species["session_id"])
+
+    index["dates"].sort()
+    return index
+
+def save_index(index, key=None):
+    key = key or config.KB_INDEX_KEY
+    s3.put_object(
+        Bucket=config.BUCKET_NAME,
+        Key=key,
+        Body=gzip.compress(json.dumps(index, separators=(",", ":")).encode("utf-8")),
+        ContentType="application/json",
+        ContentEncoding="gzip"
+    )
+    logger.info(f"Saved KB index ({len(index['dives'])} dives, {len(index['species'])} species) to s3://{config.BUCKET_NAME}/{key}")
+
+def load_index(key=None):
+    key = key or config.KB_INDEX_KEY
+    obj = s3.get_object(Bucket=config.BUCKET_NAME, Key=key)
+    return json.loads(gzip.decompress(obj["Body"].read()).decode("utf-8"))
+
+def get_index():
+    """Return the process-wide index snapshot, reloading it from S3 once it is older than KB_INDEX_TTL."""
+    with _cache_lock:
+        if _cache["index"] is None or time.time() - _cache["loaded_at"] > config.KB_INDEX_TTL:
+            _cache["index"] = load_index()
+            _cache["loaded_at"] = time.time()
+        return _cache["index"]
+
+def query_dives(index, species=None, location=None, start_date=None, end_date=None):
+    """Return the dives matching every given filter, newest first.
+
+    species and location match on substrings, so 'manta' finds 'Reef Manta Ray'. Dates
+    are inclusive YYYY-MM-DD bounds. When species is given, each result only lists the
+    sessions in which that species was seen.
+    """
+    candidates = None
+    species_sessions = {}
+
+    if species:
+        term = normalise(species)
+        for name, dives in index["species"].items():
+            if term in name:
+                for dive_id, sessions in dives.items():
+                    species_sessions.setdefault(dive_id, []).extend(sessions)
+        candidates = set(species_sessions)
+
+    if location:
+        term = normalise(location)
+        matched = {dive_id for name, dive_ids in index["locations"].items() if term in name for dive_id in dive_ids}
+        candidates = matched if candidates is None else candidates & matched
+
+    if start_date or end_date:
+        dates = index["dates"]
+        lo = bisect.bisect_left(dates, [start_date, ""]) if start_date else 0
+        # "\uffff" sorts after every dive_id, so the end date itself is included
+        hi = bisect.bisect_right(dates, [end_date, "\uffff"]) if end_date else len(dates)
+        matched = {dive_id for _, dive_id in dates[lo:hi]}
+        candidates = matched if candidates is None else candidates & matched
+
+    if candidates is None:
+        candidates = set(index["dives"])
+
+    results = []
+    for dive_id in candidates:
+        dive = dict(index["dives"][dive_id], dive_id=dive_id)
+        if species:
+            dive["sessions"] = species_sessions[dive_id]
+        results.append(dive)
+
+    return sorted(results, key=lambda d: (d["dive_date"], d["dive_id"]), reverse=True)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+import boto3
+import numpy as np
+from config import config
+
+s3 = boto3.client("s3")
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Typed columns of the flattened species_seen rows. String columns are dictionary
+# encoded: the .npy holds int32 codes and schema.json holds the values.
+COLUMNS = {
+    "dive_id": "int32",
+    "dive_date": "datetime64[D]",
+    "dive_number": "int16",
+    "dive_location": "int32",
+    "species": "int32",
+    "confidence": "int8",
+    "session_id": "int32",
+}
+STRING_COLUMNS = ("dive_id", "dive_location", "species", "session_id")
+
+def flatten_species_rows(kb):
+    """One row per species sighting, carrying the dive it belongs to."""
+    rows = []
+    for dive_id, dive in kb['dives'].items():
+        for species in dive['species_seen']:
+            rows.append({
+                "dive_id": dive_id,
+                "dive_date": dive['dive_date'],
+                "dive_number": int(dive['dive_number']),
+                "dive_location": dive['dive_location'] or "",
+                "species": species['name'],
+                "confidence": -1 if species.get('confidence') is None else int(species['confidence']),
+                "session_id": species['session_id'],
+            })
+    return rows
+
+def encode_strings(values):
+    """Dictionary-encode a list of strings into (int32 codes, vocabulary)."""
+    vocab, codes = np.unique(np.array(values, dtype=object).astype(str), return_inverse=True)
+    return codes.astype(np.int32), vocab.tolist()
+
+def export_snapshot(kb, directory):
+    """Write the flattened rows as one .npy file per column plus schema.json."""
+    os.makedirs(directory, exist_ok=True)
+    rows = flatten_species_rows(kb)
+    schema = {"rows": len(rows), "columns": COLUMNS, "vocab": {}}
+
+    for column, dtype in COLUMNS.items():
+        values = [row[column] for row in rows]
+        if column in STRING_COLUMNS:
+            array, schema["vocab"][column] = encode_strings(values)
+        else:
+            array = np.array(values, dtype=dtype)
+        np.save(os.path.join(directory, f"{column}.npy"), array)
+
+    with open(os.path.join(directory, "schema.json"), "w") as f:
+        json.dump(schema, f)
+
+    logger.info(f"Exported {len(rows)} species rows to {directory}")
+    return schema
+
+def load_snapshot(directory):
+    """Memory-map every column of a snapshot written by export_snapshot."""
+    with open(os.path.join(directory, "schema.json")) as f:
+        schema = json.load(f)
+
+    columns = {
+        column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r")
+        for column in schema["columns"]
+    }
+    return {"rows": schema["rows"], "columns": columns, "vocab": schema["vocab"]}
+
+def save_snapshot_to_s3(kb, key=None):
+    """Export the snapshot and upload it as a single gzipped tarball."""
+    key = key or config.KB_SNAPSHOT_KEY
+    temp_dir = tempfile.mkdtemp(dir=config.TEMP_DIR)
+    try:
+        snapshot_dir = os.path.join(temp_dir, "snapshot")
+        export_snapshot(kb, snapshot_dir)
+
+        archive_path = os.path.join(temp_dir, "snapshot.tar.gz")
+        with tarfile.open(archive_path, "w:gz") as tar:
+            tar.add(snapshot_dir, arcname=".")
+
+        s3.upload_file(archive_path, config.BUCKET_NAME, key)
+        logger.info(f"Uploaded KB snapshot to s3://{config.BUCKET_NAME}/{key}")
+    finally:
+        shutil.rmtree(temp_dir)
+
+def download_snapshot(directory, key=None):
+    """Download and unpack a snapshot so it can be memory-mapped with load_snapshot."""
+    key = key or config.KB_SNAPSHOT_KEY
+    os.makedirs(directory, exist_ok=True)
+    archive_path = os.path.join(directory, "snapshot.tar.gz")
+    s3.download_file(config.BUCKET_NAME, key, archive_path)
+
+    with tarfile.open(archive_path, "r:gz") as tar:
+        tar.extractall(directory)
+    os.remove(archive_path)
+    return load_snapshot(directory)
+
+# --- Analytics ---
+def species_counts(snapshot):
+    """Sightings per species, most common first."""
+    vocab = snapshot["vocab"]["species"]
+    counts = np.bincount(snapshot["columns"]["species"], minlength=len(vocab))
+    order = np.argsort(counts)[::-1]
+    return [(vocab[i], int(counts[i])) for i in order if counts[i]]
+
+def species_counts_by_location_year(snapshot):
+    """Sightings grouped by (location, year, species)."""
+    columns = snapshot["columns"]
+    if not snapshot["rows"]:
+        return []
+
+    years = columns["dive_date"].astype("datetime64[Y]").astype(np.int64) + 1970
+    keys = np.stack([columns["dive_location"].astype(np.int64), years, columns["species"].astype(np.int64)], axis=1)
+    groups, counts = np.unique(keys, axis=0, return_counts=True)
+
+    locations = snapshot["vocab"]["dive_location"]
+    species = snapshot["vocab"]["species"]
+    return [
+        {"dive_location": locations[loc], "year": int(year), "species": species[sp], "count": int(count)}
+        for (loc, year, sp), count in zip(groups, counts)
+    ]
+
+def mean_confidence_by_species(snapshot):
+    """Average GPT confidence per species, ignoring sightings without one."""
+    columns = snapshot["columns"]
+    vocab = snapshot["vocab"]["species"]
+    known = columns["confidence"] >= 0
+    species = columns["species"][known]
+
+    totals = np.bincount(species, weights=columns["confidence"][known], minlength=len(vocab))
+    counts = np.bincount(species, minlength=len(vocab))
+    return {vocab[i]: float(totals[i] / counts[i]) for i in np.flatnonzero(counts)}
+
+if __name__ == "__main__":
+    from knowledge_base import aggregate_dives, load_manifest
+
+    parser = argparse.ArgumentParser(description="Export or analyse the columnar KB snapshot")
+    parser.add_argument("--export", action="store_true", help="Rebuild the snapshot from the KB manifest and upload it")
+    parser.add_argument("--directory", default=os.path.join(config.TEMP_DIR, "kb_snapshot"), help="Local snapshot directory")
+
+    args = parser.parse_args()
+    if args.export:
+        save_snapshot_to_s3(aggregate_dives(load_manifest()))
+
+    snapshot = download_snapshot(args.directory)
+    for row in species_counts_by_location_year(snapshot):
+        print(f"{row['dive_location']:<24} {row['year']}  {row['species']:<32} {row['count']}")
@@ -1,29 +1,53 @@
+import argparse
 import boto3
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
 import logging
 import os
+import time
 from config import config
+from kb_index import build_index, save_index
 from urllib.parse import urlparse
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-s3 = boto3.client("s3")
+# One pooled client shared by every fetch worker
+s3 = boto3.client("s3", config=BotoConfig(max_pool_connections=config.KB_FETCH_WORKERS))
 
 dynamodb = boto3.resource('dynamodb', region_name = config.REGION)
 table = dynamodb.Table(config.KNOWLEDGE_BASE_TABLE)
 
+# DynamoDB limits per BatchGetItem / BatchWriteItem request
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
 
-def list_metadata_keys(prefix="dives/"):
-    """List all session_metadata.json keys in the bucket."""
-    keys = []
+
+def list_metadata_objects(prefix="dives/"):
+    """Map every session_metadata.json key in the bucket to its change watermark.
+
+    The watermark combines the ETags of the metadata and the gpt_output.json next to
+    it, so re-tagging a session or re-running GPT on it both count as a change.
+    """
+    etags = {}
     paginator = s3.get_paginator("list_objects_v2")
     for page in paginator.paginate(Bucket=config.BUCKET_NAME, Prefix=prefix):
         for obj in page.get("Contents", []):
-            if obj["Key"].endswith("session_metadata.json"):
-                keys.append(obj["Key"])
-    return keys
+            etags[obj["Key"]] = obj["ETag"]
+
+    objects = {}
+    for key, etag in etags.items():
+        if key.endswith("session_metadata.json"):
+            gpt_key = key[:-len("session_metadata.json")] + "gpt_output.json"
+            objects[key] = f"{etag}:{etags.get(gpt_key, '')}"
+    return objects
+
+def list_metadata_keys(prefix="dives/"):
+    """List all session_metadata.json keys in the bucket."""
+    return list(list_metadata_objects(prefix))
 
 def load_json_from_s3(key):
     obj = s3.get_object(Bucket=config.BUCKET_NAME, Key=key)
@@ -43,103 +67,308 @@ def extract_gpt_data(gpt_output_url):
         'confidence': data.get('confidence')
     }
 
+def load_manifest():
+    """Load the watermark manifest written by the previous run, or an empty one."""
+    try:
+        return load_json_from_s3(config.KB_MANIFEST_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            logger.info("No knowledge base manifest found, starting from scratch")
+            return {'sessions': {}}
+        raise
+
+def save_manifest(manifest):
+    s3.put_object(
+        Bucket=config.BUCKET_NAME,
+        Key=config.KB_MANIFEST_KEY,
+        Body=json.dumps(manifest).encode("utf-8")
+    )
+    logger.info(f"Saved KB manifest to s3://{config.BUCKET_NAME}/{config.KB_MANIFEST_KEY}")
+
+def build_session_entry(meta_key, etag):
+    """Fetch one session and reduce it to the manifest entry the KB is aggregated from.
+
+    Returns (entry, objects_read): the GPT output is only fetched for sessions with dive info.
+    """
+    metadata = load_json_from_s3(meta_key)
+    entry = {
+        'etag': etag,
+        's3_key': metadata.get('s3_key'),
+        'dive_id': None,
+        'dive': None,
+        'species': None
+    }
+
+    # Required metadata
+    dive_date = metadata.get('dive_date')
+    dive_number = metadata.get('dive_number')
+    if not entry['s3_key'] or not dive_date or not dive_number:
+        logger.info(f"Skipping session without dive info: {meta_key}")
+        return entry, 1
 
-def update_knowledge_base():
+    session_id = metadata.get('session_id')
+    frame_urls = metadata.get('frame_urls', [])
+
+    gpt = extract_gpt_data(metadata.get('gpt_output_url'))
+
+    if not gpt['animal'] or gpt['animal'].lower() == 'unknown':
+        return entry, 2
+
+    matched_url = next((url for url in frame_urls if gpt['filename'] in url), None)
+    if not matched_url:
+        logger.warning(f"No matching frame URL found for {gpt['filename']} in session {session_id}")
+        return entry, 2
+
+    entry['dive_id'] = f"{dive_date}_#{dive_number}"
+    entry['dive'] = {
+        'dive_date': dive_date,
+        'dive_number': dive_number,
+        'dive_location': metadata.get('dive_location')
+    }
+    entry['species'] = {
+        'name': gpt['animal'],
+        'confidence': gpt['confidence'],
+        'description': gpt['description'],
+        'image_url': matched_url,
+        'video_filename': metadata.get('video_filename'),
+        's3_key': entry['s3_key'],
+        'session_id': session_id
+    }
+    return entry, 2
+
+def aggregate_dives(manifest, dive_ids=None):
+    """Build the KB dict from manifest entries, optionally limited to the given dive_ids."""
     kb = {'dives': {}}
     seen_video_keys = set()
-    metadata_keys = list_metadata_keys()
 
-    logger.info(f"Found {len(metadata_keys)} sessions")
+    # Walk keys in listing order so the first copy of a duplicated video always wins
+    for meta_key in sorted(manifest['sessions']):
+        entry = manifest['sessions'][meta_key]
+        s3_key = entry.get('s3_key')
 
-    for meta_key in metadata_keys:
-        try:
-            metadata = load_json_from_s3(meta_key)
-            s3_key = metadata.get('s3_key')
+        # Skip any duplicates
+        if not s3_key or s3_key in seen_video_keys:
+            logger.info(f"Skipping duplicate video: {s3_key}")
+            continue
+        seen_video_keys.add(s3_key)
 
-            # Skip any duplicates
-            if not s3_key or s3_key in seen_video_keys:
-                logger.info(f"Skipping duplicate video: {s3_key}")
-                continue
-            seen_video_keys.add(s3_key)
-            
-            # Required metadata
-            dive_date = metadata.get('dive_date')
-            dive_number = metadata.get('dive_number')
-            if not dive_date or not dive_number:
-                logger.info(f"Skipping session without dive info: {meta_key}")
-                continue
+        dive_id = entry.get('dive_id')
+        if not dive_id or (dive_ids is not None and dive_id not in dive_ids):
+            continue
 
-            session_id = metadata.get('session_id')
-            video_filename = metadata.get('video_filename')
-            gpt_output_url = metadata.get('gpt_output_url')
-            frame_urls = metadata.get('frame_urls', [])
-            dive_location = metadata.get('dive_location')
+        dive_entry = kb['dives'].setdefault(dive_id, {
+            **entry['dive'],
+            'sessions': [],
+            'species_seen': []
+        })
 
-            gpt = extract_gpt_data(gpt_output_url)
+        session_id = entry['species']['session_id']
+        if session_id not in dive_entry['sessions']:
+            dive_entry['sessions'].append(session_id)
+            dive_entry['species_seen'].append(entry['species'])
 
-            if not gpt['animal'] or gpt['animal'].lower() == 'unknown':
-                continue
+    return kb
+
+def update_knowledge_base(full=False):
+    """Refresh the KB from sessions that changed since the last run.
+
+    Returns only the dives touched by new, changed or removed sessions, each rebuilt
+    from every session that belongs to it. With full=True the manifest is ignored and
+    every session is re-fetched.
+    """
+    objects = list_metadata_objects()
+    manifest = {'sessions': {}} if full else load_manifest()
+    sessions = manifest['sessions']
 
-            matched_url = next((url for url in frame_urls if gpt['filename'] in url), None)
-            if not matched_url:
-                logger.warning(f"No matching frame URL found for {gpt['filename]']} in session {session_id}")
+    changed = [key for key, etag in objects.items() if sessions.get(key, {}).get('etag') != etag]
+    removed = [key for key in sessions if key not in objects]
+    logger.info(f"Found {len(objects)} sessions: {len(changed)} new or changed, {len(removed)} removed")
+
+    touched = set()
+    for meta_key in removed:
+        touched.add(sessions.pop(meta_key).get('dive_id'))
+
+    # Fetch metadata and GPT output for every changed session concurrently, merging
+    # each result into the manifest as soon as it lands
+    objects_read = 0
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=config.KB_FETCH_WORKERS) as executor:
+        futures = {
+            executor.submit(build_session_entry, meta_key, objects[meta_key]): meta_key
+            for meta_key in changed
+        }
+        for future in as_completed(futures):
+            meta_key = futures[future]
+            try:
+                entry, gets = future.result()
+            except Exception as e:
+                logger.error(f"Error processing {meta_key}: {str(e)}")
                 continue
-            
-            dive_id = f"{dive_date}_#{dive_number}"
-            dive_entry = kb['dives'].setdefault(dive_id, {
-                'dive_date': dive_date,
-                'dive_number': dive_number,
-                'dive_location': dive_location,
-                'sessions': [],
-                'species_seen': []
-            })
-
-            if session_id not in dive_entry['sessions']:
-                dive_entry['sessions'].append(session_id)
-                dive_entry['species_seen'].append({
-                    'name': gpt['animal'],
-                    'confidence': gpt['confidence'],
-                    'description': gpt['description'], 
-                    'image_url': matched_url,
-                    'video_filename': video_filename,
-                    's3_key': s3_key,
-                    'session_id': session_id
-                })
-        
-        except Exception as e:
-            logger.error(f"Error processing {meta_key}: {str(e)}")
-            continue
 
+            objects_read += gets
+            if meta_key in sessions:
+                touched.add(sessions[meta_key].get('dive_id'))
+            touched.add(entry['dive_id'])
+            sessions[meta_key] = entry
+
+    elapsed = time.time() - start_time
+    if changed:
+        logger.info(
+            f"Fetched {objects_read} objects in {elapsed:.2f}s "
+            f"({objects_read / max(elapsed, 1e-6):.1f} objects/s, {config.KB_FETCH_WORKERS} workers)"
+        )
+
+    touched.discard(None)
+
+    kb = aggregate_dives(manifest, dive_ids=None if full else touched)
+    # The query index always covers every dive, not just the ones touched by this run
+    save_index(build_index(kb if full else aggregate_dives(manifest)))
+
+    # Dives whose last session moved away or disappeared. A full rebuild has no previous
+    # manifest to diff against, so it compares with what is stored in DynamoDB instead
+    stale = list_stored_dive_ids() if full else touched
+    kb['removed_dives'] = sorted(stale - kb['dives'].keys())
+    logger.info(f"Rebuilt {len(kb['dives'])} dives, {len(kb['removed_dives'])} no longer have sessions")
+
+    # Only saved by sync_knowledge_base once DynamoDB has caught up, so a failed sync is retried
+    kb['manifest'] = manifest
     return kb
 
+def list_stored_dive_ids():
+    """Every dive_id currently in the dive-knowledge-base table."""
+    dive_ids = set()
+    scan_kwargs = {'ProjectionExpression': 'dive_id'}
+    while True:
+        response = table.scan(**scan_kwargs)
+        dive_ids.update(item['dive_id'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return dive_ids
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def content_hash(item):
+    """Stable hash of a KB item, stored alongside it so change checks only read the hash."""
+    return hashlib.sha256(json.dumps(item, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def batch_get_content_hashes(dive_ids, max_retries=5):
+    """Read the stored content_hash for each dive_id, 100 keys per batch_get_item call.
+
+    Returns ({dive_id: content_hash}, round_trips). Unprocessed keys are retried with
+    exponential backoff.
+    """
+    hashes = {}
+    round_trips = 0
+    dive_ids = list(dive_ids)
+
+    for i in range(0, len(dive_ids), BATCH_GET_SIZE):
+        request = {
+            config.KNOWLEDGE_BASE_TABLE: {
+                'Keys': [{"dive_id": dive_id} for dive_id in dive_ids[i:i + BATCH_GET_SIZE]],
+                'ProjectionExpression': 'dive_id, content_hash'
+            }
+        }
+        for attempt in range(max_retries + 1):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            round_trips += 1
+            for item in response.get('Responses', {}).get(config.KNOWLEDGE_BASE_TABLE, []):
+                hashes[item['dive_id']] = item.get('content_hash')
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            if attempt == max_retries:
+                raise RuntimeError(f"DynamoDB left keys unprocessed after {max_retries} retries")
+            wait_time = 0.05 * 2 ** attempt
+            logger.warning(f"DynamoDB returned unprocessed keys. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+
+    return hashes, round_trips
+
+def batch_write_dives(requests, max_retries=5):
+    """Send put/delete requests 25 per batch_write_item call. Returns the number of round trips.
+
+    Unprocessed items are retried with exponential backoff.
+    """
+    round_trips = 0
+
+    for i in range(0, len(requests), BATCH_WRITE_SIZE):
+        request = {config.KNOWLEDGE_BASE_TABLE: requests[i:i + BATCH_WRITE_SIZE]}
+        for attempt in range(max_retries + 1):
+            response = dynamodb.batch_write_item(RequestItems=request)
+            round_trips += 1
+
+            request = response.get('UnprocessedItems')
+            if not request:
+                break
+            if attempt == max_retries:
+                raise RuntimeError(f"DynamoDB left items unprocessed after {max_retries} retries")
+            wait_time = 0.05 * 2 ** attempt
+            logger.warning(f"DynamoDB returned unprocessed items. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+
+    return round_trips
+
 def update_dynamodb_from_kb(kb):
+    """Write new or changed dives to DynamoDB in batches and delete removed ones.
+
+    Returns a summary with the measured round trips; `ok` is False if a read or write failed.
+    """
+    items = {}
     for dive_id, dive_data in kb['dives'].items():
-        try:
-            # Fetch the current record from DynamoDB
-            response = table.get_item(Key = {"dive_id": dive_id})
-            existing_item = response.get("Item", {})
-
-            # Compare existing item to new data
-
-            new_data = {
-                "dive_id": dive_id,
-                "dive_date": dive_data["dive_date"],
-                "dive_number": dive_data["dive_number"],
-                "dive_location": dive_data["dive_location"],
-                "sessions": dive_data["sessions"],
-                "species_seen": dive_data["species_seen"]
-            }
+        new_data = {
+            "dive_id": dive_id,
+            "dive_date": dive_data["dive_date"],
+            "dive_number": dive_data["dive_number"],
+            "dive_location": dive_data["dive_location"],
+            "sessions": dive_data["sessions"],
+            "species_seen": dive_data["species_seen"]
+        }
+        new_data["content_hash"] = content_hash(new_data)
+        items[dive_id] = new_data
 
-            if existing_item and existing_item == new_data:
-                logger.info(f"No change for {dive_id}, skipping update to dive-knowledge-base")
-                continue
+    removed = kb.get('removed_dives', [])
+    result = {"ok": False, "error": None, "reads": 0, "writes": 0, "changed": 0, "removed": len(removed)}
 
-            # Update or insert
-            table.put_item(Item = new_data)
-            logger.info(f"{'Updated' if existing_item else 'Inserted'} dive {dive_id} in dynamodb table dive-knowledge-base")
-         
-        except ClientError as e:
-            logger.error(f"Failed to update dive {dive_id}: {str(e)}")
+    try:
+        existing_hashes, result["reads"] = batch_get_content_hashes(items)
+    except (ClientError, RuntimeError) as e:
+        logger.error(f"Failed to read existing dives from dive-knowledge-base: {str(e)}")
+        result["error"] = str(e)
+        return result
+
+    changed = [item for dive_id, item in items.items() if existing_hashes.get(dive_id) != item["content_hash"]]
+    result["changed"] = len(changed)
+    logger.info(f"{len(items) - len(changed)} dives unchanged, skipping update to dive-knowledge-base")
+
+    requests = [{"PutRequest": {"Item": item}} for item in changed]
+    requests += [{"DeleteRequest": {"Key": {"dive_id": dive_id}}} for dive_id in removed]
+    try:
+        result["writes"] = batch_write_dives(requests)
+    except (ClientError, RuntimeError) as e:
+        logger.error(f"Failed to write dives to dive-knowledge-base: {str(e)}")
+        result["error"] = str(e)
+        return result
+
+    for item in changed:
+        logger.info(f"{'Updated' if item['dive_id'] in existing_hashes else 'Inserted'} dive {item['dive_id']} in dynamodb table dive-knowledge-base")
+    for dive_id in removed:
+        logger.info(f"Deleted dive {dive_id} from dynamodb table dive-knowledge-base")
+
+    logger.info(
+        f"Synced {len(items)} dives in {result['reads'] + result['writes']} round trips "
+        f"({result['reads']} reads, {result['writes']} writes)"
+    )
+    result["ok"] = True
+    return result
+
+def sync_knowledge_base(full=False):
+    """Refresh the KB and push it to DynamoDB, committing the manifest only if the sync succeeds."""
+    kb = update_knowledge_base(full=full)
+    result = update_dynamodb_from_kb(kb)
+    if not result["ok"]:
+        logger.warning("DynamoDB sync failed, keeping the previous KB manifest so the next run retries these dives")
+        return result
+    save_manifest(kb['manifest'])
+    return result
 
 '''def save_kb_to_s3(kb, key = "brain_kb.json"):
     s3.put_object(
@@ -152,4 +381,8 @@ def update_dynamodb_from_kb(kb):
 if __name__ == "__main__":
     #print(extract_gpt_data('https://vivian-dive-bucket.s3.ap-southeast-2.amazonaws.com/dives/20250602093056_fbe6dcd954/gpt_output.json'))
     #print(update_knowledge_base())
-    update_dynamodb_from_kb(kb = update_knowledge_base())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sync the dive knowledge base from processed sessions")
+    parser.add_argument("--full", action="store_true", help="Ignore the manifest and rebuild every dive")
+
+    args = parser.parse_args()
+    sync_knowledge_base(full=args.full)
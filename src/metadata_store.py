@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from config import config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# S3 error codes meaning another writer got there first
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+def metadata_key(session_id):
+    return f"processed/{session_id}/session_metadata.json"
+
+class SessionMetadataStore:
+    """Session metadata documents with write-behind, conflict-safe persistence.
+
+    update() queues fields and returns straight away. Updates to the same session within
+    `flush_delay` seconds are coalesced into one write on a background timer; a failed
+    write is retried with backoff and reported through pop_error(). Each write is a PUT
+    conditional on the ETag of the last document this store saw, so fields written
+    concurrently by the pipeline or tag_session are never clobbered: on a conflict the
+    document is re-read and merged again.
+    """
+
+    def __init__(self, s3_client, bucket=None, flush_delay=0.5, max_retries=5, max_flush_backoff=60):
+        self.s3 = s3_client
+        self.bucket = bucket or config.BUCKET_NAME
+        self.flush_delay = flush_delay
+        self.max_retries = max_retries
+        self.max_flush_backoff = max_flush_backoff
+
+        # session_id -> (document, etag) as last read or written
+        self._docs = {}
+        self._pending = {}
+        self._timers = {}
+        self._failed_flushes = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+        # Don't lose queued updates when the process exits between timer ticks
+        atexit.register(self.close)
+
+    def update(self, session_id, **fields):
+        """Queue fields for a session and schedule a flush."""
+        with self._lock:
+            self._pending.setdefault(session_id, {}).update(fields)
+            self._schedule(session_id, self.flush_delay)
+
+    def pop_error(self, session_id):
+        """The error from the last failed background flush for a session, if any, clearing it."""
+        with self._lock:
+            return self._errors.pop(session_id, None)
+
+    def _schedule(self, session_id, delay):
+        # Caller holds self._lock
+        timer = self._timers.pop(session_id, None)
+        if timer:
+            timer.cancel()
+        timer = threading.Timer(delay, self._flush_quietly, args=(session_id,))
+        timer.daemon = True
+        self._timers[session_id] = timer
+        timer.start()
+
+    def flush(self, session_id=None):
+        """Write pending fields now, for one session or for all of them."""
+        with self._lock:
+            session_ids = [session_id] if session_id else list(self._pending)
+
+        for sid in session_ids:
+            with self._lock:
+                timer = self._timers.pop(sid, None)
+                if timer:
+                    timer.cancel()
+                fields = self._pending.pop(sid, None)
+            if not fields:
+                continue
+            try:
+                self.merge(sid, fields)
+            except Exception:
+                # Put the fields back, underneath anything queued since, so the next flush retries them
+                with self._lock:
+                    self._pending[sid] = {**fields, **self._pending.get(sid, {})}
+                raise
+
+    def close(self):
+        """Flush every session with pending fields, logging any that still fail."""
+        with self._lock:
+            session_ids = list(self._pending)
+        for session_id in session_ids:
+            try:
+                self.flush(session_id)
+            except Exception as e:
+                logger.error(f"❌ Session metadata for {session_id} was not saved: {e}")
+
+    def _flush_quietly(self, session_id):
+        try:
+            self.flush(session_id)
+        except Exception as e:
+            with self._lock:
+                failures = self._failed_flushes.get(session_id, 0) + 1
+                self._failed_flushes[session_id] = failures
+                self._errors[session_id] = str(e)
+                # An update() since may already have scheduled the retry
+                if session_id not in self._timers:
+                    delay = min(self.flush_delay * 2 ** failures, self.max_flush_backoff)
+                    self._schedule(session_id, delay)
+            logger.error(f"❌ Failed to flush session metadata for {session_id}, retrying: {e}")
+            return
+
+        with self._lock:
+            self._failed_flushes.pop(session_id, None)
+
+    def _read(self, session_id):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=metadata_key(session_id))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return {}, None
+            raise
+        return json.loads(obj["Body"].read().decode("utf-8")), obj["ETag"]
+
+    def merge(self, session_id, fields, defaults=None, require_existing=False):
+        """Synchronously merge fields into the stored document with a conditional write.
+
+        `defaults` are only applied where the stored document has no value yet. The write
+        starts from the cached document when there is one, and only re-reads it if
+        another writer changed it in between.
+        """
+        for attempt in range(self.max_retries + 1):
+            with self._lock:
+                cached = self._docs.get(session_id)
+            if cached:
+                document, etag = dict(cached[0]), cached[1]
+            else:
+                document, etag = self._read(session_id)
+            if etag is None and require_existing:
+                raise LookupError(f"No session metadata found for {session_id}")
+
+            for field, value in (defaults or {}).items():
+                if document.get(field) is None:
+                    document[field] = value
+            document.update(fields)
+
+            # Create only if still absent, otherwise replace only the version we know about
+            condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+            try:
+                response = self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=metadata_key(session_id),
+                    Body=json.dumps(document, indent=2).encode("utf-8"),
+                    ContentType="application/json",
+                    **condition
+                )
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                # IfMatch on a document deleted since we cached it fails with NoSuchKey
+                conflict = code in CONFLICT_CODES or (cached and code == 'NoSuchKey')
+                if conflict and attempt < self.max_retries:
+                    with self._lock:
+                        self._docs.pop(session_id, None)
+                    wait_time = 0.05 * 2 ** attempt
+                    logger.warning(f"Session metadata for {session_id} changed underneath us. Retrying in {wait_time:.2f} seconds...")
+                    time.sleep(wait_time)
+                    continue
+                raise
+
+            with self._lock:
+                self._docs[session_id] = (document, response["ETag"])
+            logger.info(f"✅ Session metadata saved to s3://{self.bucket}/{metadata_key(session_id)}")
+            return document
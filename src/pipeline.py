@@ -2,27 +2,48 @@ import os
 import datetime
 import secrets
 import logging
-import json
 import boto3
 import hashlib
+import time
 
 from config import config 
 from extract_frames import extract_frames
-from analyse_with_gpt import analyse_with_gpt, load_system_prompt
-from utils import write_to_s3, download_video_from_s3
+from analyse_with_gpt import analyse_with_gpt, analyse_clips_with_gpt, load_system_prompt
+from metadata_store import SessionMetadataStore
+from utils import write_to_s3, write_status, download_video_from_s3
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 s3 = boto3.client('s3')
+metadata_store = SessionMetadataStore(s3)
 
 def generate_session_id(s3_key):
     return hashlib.md5(s3_key.encode()).hexdigest()
 
-def run_pipeline(s3_key):
-    session_id = generate_session_id(s3_key)
+def extraction_deadline(deadline):
+    """Deadline for frame extraction, leaving config.DEADLINE_RESERVE_SECONDS for uploads and GPT."""
+    return deadline - config.DEADLINE_RESERVE_SECONDS if deadline is not None else None
 
+def report_progress(session_id, stage, **details):
+    """Publish a status that is only informational: a failed write is logged, never raised."""
     try:
+        write_status(session_id, stage, **details)
+    except Exception as e:
+        logger.error(f"Could not publish {stage} status for {session_id}: {str(e)}")
+
+def report_failure(session_id, s3_key, error):
+    # Must not mask the original error if the status write fails too
+    report_progress(session_id, "failed", s3_key=s3_key, error=str(error))
+
+def extract_session(s3_key, session_id, deadline=None):
+    """Download a video and extract its frames, previews and score index. Returns (image_urls, preview_keys).
+
+    deadline is a time.monotonic() timestamp by which extraction has to finish.
+    """
+    temp_video_path = None
+    try:
+        report_progress(session_id, "downloading", s3_key=s3_key)
         logger.info(f"Downloading the video from S3: {s3_key}")
 
         # Extract the filename from the s3 key and download directly to the /tmp directory
@@ -33,51 +54,112 @@ def run_pipeline(s3_key):
         
         base_prefix = f"processed/{session_id}"
         frames_prefix = f"{base_prefix}/frames"
-        metadata_key = f"{base_prefix}/session_metadata.json"
-        gpt_output_key = f"{base_prefix}/gpt_output.json"
-        reasoning_key = f"{base_prefix}/reasoning.txt"
 
         logger.info(f"Processing dive session with s3 key: {s3_key} | Session ID: {session_id}")
 
         # Extract and upload frames
-        image_urls = extract_frames(
+        report_progress(session_id, "extracting_frames", s3_key=s3_key)
+        return extract_frames(
             temp_video_path, 
             s3,  
             frames_prefix, 
             config.MAX_FRAMES, 
-            config.FRAME_INTERVAL
+            config.FRAME_INTERVAL,
+            preview_prefix=base_prefix,
+            deadline=deadline,
+            score_index_key=f"{base_prefix}/frame_scores.npy"
         )
+
+    finally:
+        if temp_video_path and os.path.exists(temp_video_path):
+            os.remove(temp_video_path)
+
+def save_session_results(s3_key, session_id, gpt_result, preview_keys):
+    base_prefix = f"processed/{session_id}"
+    metadata_key = f"{base_prefix}/session_metadata.json"
+    gpt_output_key = f"{base_prefix}/gpt_output.json"
+    reasoning_key = f"{base_prefix}/reasoning.txt"
+
+    # Upload reasoning and JSON to S3
+    write_to_s3(gpt_result['json_only'], config.BUCKET_NAME, gpt_output_key)
+
+    # Session metadata. Dive details may already have been tagged from the chat
+    # while the pipeline was running, so they only default to None.
+    metadata = {
+        'session_id': session_id,
+        'video_filename': s3_key.split("/")[-1],
+        's3_key': s3_key,
+        'gpt_output_url': gpt_output_key,
+        **preview_keys
+    }
+    metadata_store.merge(session_id, metadata, defaults={
+        'dive_date': None,
+        'dive_number': None,
+        'dive_location': None
+    })
+
+    write_status(session_id, "complete", s3_key=s3_key, metadata_key=metadata_key, **preview_keys)
+
+def run_pipeline(s3_key, deadline=None):
+    """Process one clip. With a deadline (time.monotonic() timestamp, e.g. from the Lambda
+    context), frame extraction stops early enough for the rest of the pipeline to finish."""
+    session_id = generate_session_id(s3_key)
+
+    try:
+        image_urls, preview_keys = extract_session(s3_key, session_id, extraction_deadline(deadline))
         
         # Run GPT analysis
+        report_progress(session_id, "analysing", s3_key=s3_key)
         system_prompt = load_system_prompt()
         logger.debug(f"Image URLs: {image_urls}")
         gpt_result = analyse_with_gpt(image_urls, system_prompt)
 
-        # Upload reasoning and JSON to S3
-        write_to_s3(gpt_result['json_only'], config.BUCKET_NAME, gpt_output_key)
-
-        # Session metadata
-        metadata = {
-            'session_id': session_id,
-            'video_filename': s3_key.split("/")[-1],
-            's3_key': s3_key,
-            'dive_date': None,
-            'dive_number': None,
-            'dive_location': None,
-            'gpt_output_url': gpt_output_key
-        }
-        write_to_s3(json.dumps(metadata, indent=2), config.BUCKET_NAME, metadata_key)
-
+        save_session_results(s3_key, session_id, gpt_result, preview_keys)
         logger.info(f"Dive Pipeline Complete: {session_id}")
         return session_id
     
     except Exception as e:
         logger.error(f"Dive Pipeline Failed: {str(e)}")
+        report_failure(session_id, s3_key, e)
+        raise
+
+def run_pipeline_batch(s3_keys, deadline=None):
+    """Process several clips from the same dive with a single GPT request.
+
+    Frames are extracted per clip as usual, then analysed together so the system prompt
+    is only sent once. Returns the session IDs in the order of s3_keys. With a deadline,
+    the extraction budget is shared out evenly between the clips still to go.
+    """
+    session_ids = {s3_key: generate_session_id(s3_key) for s3_key in s3_keys}
+    extract_by = extraction_deadline(deadline)
+
+    try:
+        clips = {}
+        previews = {}
+        for n, (s3_key, session_id) in enumerate(session_ids.items()):
+            clip_deadline = None
+            if extract_by is not None:
+                now = time.monotonic()
+                clip_deadline = now + (extract_by - now) / (len(session_ids) - n)
+            clips[session_id], previews[session_id] = extract_session(s3_key, session_id, clip_deadline)
+
+        # Run one GPT analysis for the whole dive
+        for s3_key, session_id in session_ids.items():
+            report_progress(session_id, "analysing", s3_key=s3_key)
+        system_prompt = load_system_prompt()
+        gpt_results = analyse_clips_with_gpt(clips, system_prompt)
+
+        for s3_key, session_id in session_ids.items():
+            save_session_results(s3_key, session_id, gpt_results[session_id], previews[session_id])
+
+        logger.info(f"Dive Pipeline Complete for {len(session_ids)} clips: {list(session_ids.values())}")
+        return list(session_ids.values())
+
+    except Exception as e:
+        logger.error(f"Dive Pipeline Failed: {str(e)}")
+        for s3_key, session_id in session_ids.items():
+            report_failure(session_id, s3_key, e)
         raise
-    
-    finally:
-        if temp_video_path and os.path.exists(temp_video_path):
-            os.remove(temp_video_path)
 
 if __name__ == "__main__":
     run_pipeline(s3_key = 'raw/VID-20250411-WA0001~2.mp4')
\ No newline at end of file
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TokenBucketLimiter:
+    """Client-side token bucket shared by every caller of one model in this process.
+
+    Callers block in acquire() until a token is free instead of hitting the provider's
+    throttle. Waiting callers are queued per client (e.g. per chat session) and served
+    round-robin, so one busy session can't starve the others.
+    """
+
+    def __init__(self, name, rate_per_minute, burst=None):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst or max(1, rate_per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _is_next(self, ticket):
+        return bool(self._queues) and next(iter(self._queues.values()))[0] is ticket
+
+    def _next_delay(self, ticket, start, timeout):
+        """Seconds to wait before checking again (None = until notified). Call with the lock held.
+
+        Returns 0 once `ticket` may take a token, and raises TimeoutError past `timeout`.
+        """
+        self._refill()
+        if self._is_next(ticket) and self.tokens >= 1:
+            return 0
+
+        delay = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+        if timeout is not None:
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out after {timeout}s waiting for a {self.name} rate limit token")
+            delay = remaining if delay is None else min(delay, remaining)
+        return delay
+
+    def _leave_queue(self, client_id, ticket):
+        queue = self._queues[client_id]
+        queue.remove(ticket)
+        if queue:
+            # Round-robin: this client goes to the back of the line
+            self._queues.move_to_end(client_id)
+        else:
+            del self._queues[client_id]
+        self._cond.notify_all()
+
+    def _record_wait(self, start):
+        waited = time.monotonic() - start
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def acquire(self, client_id="default", timeout=None):
+        """Block until this client's turn comes up and a token is free. Returns the wait in seconds.
+
+        Raises TimeoutError if no token was granted within `timeout` seconds.
+        """
+        ticket = object()
+        start = time.monotonic()
+
+        with self._cond:
+            self._queues.setdefault(client_id, deque()).append(ticket)
+            try:
+                while True:
+                    delay = self._next_delay(ticket, start, timeout)
+                    if delay == 0:
+                        break
+                    self._cond.wait(delay)
+
+                self.tokens -= 1
+            finally:
+                self._leave_queue(client_id, ticket)
+            waited = self._record_wait(start)
+
+        if waited > 1:
+            logger.info(f"⏳ Waited {waited:.2f}s for a {self.name} rate limit token")
+        return waited
+
+    async def acquire_async(self, client_id="default", timeout=None, poll_interval=0.01):
+        """asyncio counterpart of acquire(), sharing the same bucket and queue.
+
+        Waits with asyncio.sleep instead of blocking the event loop. Sync waiters are woken
+        by notify, so while another client is ahead in line this re-checks every
+        poll_interval seconds instead.
+        """
+        ticket = object()
+        start = time.monotonic()
+
+        with self._cond:
+            self._queues.setdefault(client_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    delay = self._next_delay(ticket, start, timeout)
+                    if delay == 0:
+                        self.tokens -= 1
+                        waited = self._record_wait(start)
+                        break
+                    # Only the head of the line can sleep until its token is due
+                    if not self._is_next(ticket):
+                        delay = poll_interval if delay is None else min(delay, poll_interval)
+                await asyncio.sleep(delay)
+        finally:
+            with self._cond:
+                self._leave_queue(client_id, ticket)
+
+        if waited > 1:
+            logger.info(f"⏳ Waited {waited:.2f}s for a {self.name} rate limit token")
+        return waited
+
+    def penalize(self):
+        """Empty the bucket after the provider throttled us anyway, so every caller slows down."""
+        with self._cond:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "name": self.name,
+                "rate_per_minute": self.rate * 60,
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "waiting_clients": len(self._queues),
+                "acquired": self.acquired,
+                "avg_wait_s": self.total_wait / self.acquired if self.acquired else 0.0,
+                "max_wait_s": self.max_wait,
+            }
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(key, rate_per_minute):
+    """Return the process-wide limiter for a model ID, creating it on first use."""
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = TokenBucketLimiter(key, rate_per_minute)
+        return _limiters[key]
@@ -0,0 +1,144 @@
+import argparse
+import os
+import boto3
+import cv2
+import logging
+import numpy as np
+
+from config import config
+from extract_frames import combine_scores, hamming
+from metadata_store import SessionMetadataStore, metadata_key
+from utils import download_video_from_s3, generate_presigned_url, load_json_from_s3, write_to_s3
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+s3 = boto3.client('s3')
+metadata_store = SessionMetadataStore(s3)
+
+def load_score_index(key, directory=config.TEMP_DIR):
+    """Download a session's score index and memory-map it."""
+    path = os.path.join(directory, key.replace("/", "_"))
+    s3.download_file(config.BUCKET_NAME, key, path)
+    try:
+        return np.load(path, mmap_mode="r")
+    finally:
+        # The mapping stays valid once the file is unlinked, and /tmp is not left holding a copy
+        os.remove(path)
+
+def select_frames(index, max_frames, sharpness_weight=config.SHARPNESS_WEIGHT, saliency_weight=config.SALIENCY_WEIGHT,
+                  min_distance=0):
+    """Pick the best max_frames frame indices from a score index, best first. Pruned candidates
+    only top up a clip with too few segments; min_distance skips near-duplicate perceptual hashes."""
+    scores = combine_scores(index["sharpness"].astype(np.float64), index["saliency"].astype(np.float64),
+                            sharpness_weight, saliency_weight)
+    pruned = index["frame_idx"] != index["representative"]
+
+    chosen = []
+    hashes = []
+    for i in np.lexsort((-scores, pruned)):
+        phash = int(index["phash"][i])
+        if any(hamming(phash, other) < min_distance for other in hashes):
+            continue
+        chosen.append(int(index["frame_idx"][i]))
+        hashes.append(phash)
+        if len(chosen) == max_frames:
+            break
+    return chosen
+
+def decode_frames(video_source, frame_indices):
+    """Seek to and decode only the given frames from a local path or URL. Returns {frame_index: frame}."""
+    cap = cv2.VideoCapture(video_source)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video: {video_source.split('?')[0]}")
+
+    frames = {}
+    try:
+        for idx in sorted(frame_indices):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            ret, frame = cap.read()
+            if not ret:
+                raise ValueError(f"Could not decode frame {idx} of {video_source.split('?')[0]}")
+            frames[idx] = frame
+    finally:
+        cap.release()
+    return frames
+
+def read_original_frames(s3_key, frame_indices):
+    """Decode frames of an original upload by streaming only the byte ranges FFmpeg needs
+    from a presigned URL, downloading the whole file only if that fails."""
+    try:
+        return decode_frames(generate_presigned_url(config.BUCKET_NAME, s3_key), frame_indices)
+    except ValueError as e:
+        logger.warning(f"Streaming {s3_key} failed ({e}), downloading it instead")
+
+    temp_video_path = f"{config.TEMP_DIR}/{s3_key.split('/')[-1]}"
+    try:
+        download_video_from_s3(config.BUCKET_NAME, s3_key, temp_video_path)
+        return decode_frames(temp_video_path, frame_indices)
+    finally:
+        if os.path.exists(temp_video_path):
+            os.remove(temp_video_path)
+
+def reselect_frames(session_id, max_frames=config.MAX_FRAMES, sharpness_weight=config.SHARPNESS_WEIGHT,
+                    saliency_weight=config.SALIENCY_WEIGHT, min_distance=0, analyse=False):
+    """Choose and upload a new set of frames for a session from its score index and return their
+    presigned URLs. With analyse, they are also sent to GPT, replacing gpt_output.json."""
+    metadata = load_json_from_s3(metadata_key(session_id))
+    if not metadata.get('score_index_key'):
+        raise LookupError(f"Session {session_id} has no score index, re-run the pipeline for it first")
+
+    index = load_score_index(metadata['score_index_key'])
+    chosen = select_frames(index, max_frames, sharpness_weight, saliency_weight, min_distance)
+    logger.info(f"Selected frames {chosen} from {len(index)} candidates for session {session_id}")
+
+    base_prefix = f"processed/{session_id}"
+    frames = read_original_frames(metadata['s3_key'], chosen)
+
+    # Earlier frames stay in place: the current gpt_output.json may still refer to them
+    frame_urls = []
+    filenames = []
+    for i, idx in enumerate(chosen):
+        filename = f"frame_{i+1}_at_{idx}.jpg"
+        filepath = os.path.join(config.TEMP_DIR, f"{session_id}_{filename}")
+        key = f"{base_prefix}/frames/{filename}"
+
+        cv2.imwrite(filepath, frames[idx])
+        s3.upload_file(filepath, config.BUCKET_NAME, key)
+        logger.info(f"Uploaded frame {i+1} to s3://{config.BUCKET_NAME}/{key}")
+        os.remove(filepath)
+
+        frame_urls.append(generate_presigned_url(config.BUCKET_NAME, key))
+        filenames.append(filename)
+
+    if analyse:
+        from analyse_with_gpt import analyse_with_gpt, load_system_prompt
+        gpt_result = analyse_with_gpt(frame_urls, load_system_prompt())
+        write_to_s3(gpt_result['json_only'], config.BUCKET_NAME, f"{base_prefix}/gpt_output.json")
+
+    metadata_store.merge(session_id, {
+        'frame_selection': {
+            'frames': filenames,
+            'max_frames': max_frames,
+            'sharpness_weight': sharpness_weight,
+            'saliency_weight': saliency_weight,
+            'min_distance': min_distance,
+            'analysed': analyse
+        }
+    })
+    return frame_urls
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-select a session's frames from its score index without re-scoring the video")
+    parser.add_argument("--session_id", required=True, help="The session ID to re-select frames for")
+    parser.add_argument("--max_frames", type=int, default=config.MAX_FRAMES, help="Number of frames to select")
+    parser.add_argument("--sharpness_weight", type=float, default=config.SHARPNESS_WEIGHT)
+    parser.add_argument("--saliency_weight", type=float, default=config.SALIENCY_WEIGHT)
+    parser.add_argument("--min_distance", type=int, default=0, help="Minimum perceptual hash distance (bits) between selected frames")
+    parser.add_argument("--analyse", action="store_true", help="Re-run the GPT analysis on the new frames")
+
+    args = parser.parse_args()
+    urls = reselect_frames(args.session_id, args.max_frames, args.sharpness_weight, args.saliency_weight,
+                           args.min_distance, args.analyse)
+    for url in urls:
+        print(url)
@@ -1,44 +1,105 @@
 import argparse
+import csv
 import json
 import boto3
 import logging
-from config import config
+from botocore.config import Config as BotoConfig
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metadata_store import SessionMetadataStore
 
-s3 = boto3.client("s3")
+MAX_WORKERS = 32
+
+# One client shared by every bulk worker, with a connection per worker
+s3 = boto3.client("s3", config=BotoConfig(max_pool_connections=MAX_WORKERS))
+metadata_store = SessionMetadataStore(s3)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def update_session_metadata(session_id, dive_date=None, dive_number=None, dive_location=None):
-    base_prefix = f"processed/{session_id}"
-    metadata_key = f"{base_prefix}/session_metadata.json"
+BULK_FIELDS = ("session_id", "dive_date", "dive_number", "dive_location")
 
-    try:
-        obj = s3.get_object(Bucket=config.BUCKET_NAME, Key=metadata_key)
-        metadata = json.loads(obj["Body"].read().decode("utf-8"))
-    
-        metadata["dive_date"] = dive_date
-        metadata["dive_number"] = int(dive_number)
-        metadata["dive_location"] = dive_location
-
-        s3.put_object(
-            Bucket=config.BUCKET_NAME,
-            Key=metadata_key,
-            Body=json.dumps(metadata, indent=2).encode("utf-8")
-        )
+def apply_session_tags(session_id, dive_date=None, dive_number=None, dive_location=None):
+    # Conditional merge, so a concurrent pipeline or chat write isn't clobbered
+    metadata_store.merge(session_id, {
+        "dive_date": dive_date,
+        "dive_number": int(dive_number),
+        "dive_location": dive_location
+    }, require_existing=True)
 
+def update_session_metadata(session_id, dive_date=None, dive_number=None, dive_location=None):
+    try:
+        apply_session_tags(session_id, dive_date, dive_number, dive_location)
         logger.info(f"Updated session {session_id} with dive date {dive_date}, dive number {dive_number}, and location {dive_location}")
+        return True
 
     except Exception as e:
         logger.error(f"Error updating session {session_id}: {str(e)}")
+        return False
+
+def read_bulk_rows(path):
+    """Read tagging rows from a CSV (with a header) or JSONL file."""
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return list(csv.DictReader(f))
+
+def missing_fields(row):
+    return [field for field in BULK_FIELDS if not row.get(field)]
+
+def tag_sessions_bulk(rows, workers=8):
+    """Tag many sessions concurrently. Returns one result per row, in input order.
+
+    Rows missing a required field are reported as failed without being sent.
+    """
+    results = [None] * len(rows)
+
+    with ThreadPoolExecutor(max_workers=min(workers, MAX_WORKERS)) as executor:
+        futures = {}
+        for i, row in enumerate(rows):
+            missing = missing_fields(row)
+            if missing:
+                results[i] = {"session_id": row.get("session_id"), "ok": False,
+                              "error": f"Row {i + 1} is missing {', '.join(missing)}"}
+                continue
+            futures[executor.submit(apply_session_tags, *(row[field] for field in BULK_FIELDS))] = i
+
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                future.result()
+                results[i] = {"session_id": rows[i]["session_id"], "ok": True, "error": None}
+            except Exception as e:
+                results[i] = {"session_id": rows[i]["session_id"], "ok": False, "error": str(e)}
+
+    for result in results:
+        if result["ok"]:
+            logger.info(f"✅ {result['session_id']}")
+        else:
+            logger.error(f"❌ {result['session_id']}: {result['error']}")
+
+    succeeded = sum(result["ok"] for result in results)
+    logger.info(f"Tagged {succeeded}/{len(results)} sessions")
+    return results
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tag a dive session with dive date and number")
-    parser.add_argument("--session_id", required=True, help="The session ID to update")
-    parser.add_argument("--dive_date", required=True, help="The dive date in YYYY-MM-DD format")
-    parser.add_argument("--dive_number", required=True, help="Dive number of the day (int)")
-    parser.add_argument("--dive_location", required=True, help="Dive location")
+    parser.add_argument("--session_id", help="The session ID to update")
+    parser.add_argument("--dive_date", help="The dive date in YYYY-MM-DD format")
+    parser.add_argument("--dive_number", help="Dive number of the day (int)")
+    parser.add_argument("--dive_location", help="Dive location")
+    parser.add_argument("--bulk", help="CSV or JSONL file with session_id, dive_date, dive_number, dive_location per row")
+    parser.add_argument("--workers", type=int, default=8, help=f"Concurrent updates in bulk mode (max {MAX_WORKERS})")
+    parser.add_argument("--refresh-kb", action="store_true", help="Run one incremental knowledge base refresh after tagging")
 
     args = parser.parse_args()
-    update_session_metadata(args.session_id, args.dive_date, args.dive_number, args.dive_location)
+    if args.bulk:
+        results = tag_sessions_bulk(read_bulk_rows(args.bulk), args.workers)
+        tagged_any = any(result["ok"] for result in results)
+    elif all((args.session_id, args.dive_date, args.dive_number, args.dive_location)):
+        tagged_any = update_session_metadata(args.session_id, args.dive_date, args.dive_number, args.dive_location)
+    else:
+        parser.error("either --bulk or all of --session_id, --dive_date, --dive_number and --dive_location are required")
 
+    if args.refresh_kb and tagged_any:
+        from knowledge_base import sync_knowledge_base
+        sync_knowledge_base()
@@ -1,6 +1,8 @@
 import boto3
 import io
 import logging
+import time
+from botocore.exceptions import ClientError
 from config import config
 import json
 
@@ -31,4 +33,30 @@ def generate_presigned_url(bucket_name, s3_key,expiration = 3600):
 
 def load_json_from_s3(key):
     response = s3.get_object(Bucket=config.BUCKET_NAME, Key=key)
-    return json.loads(response['Body'].read().decode('utf-8'))
\ No newline at end of file
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+# Ordered pipeline stages reported in processed/<session_id>/status.json
+PIPELINE_STAGES = ["downloading", "extracting_frames", "analysing", "complete"]
+
+def status_key(session_id):
+    return f"processed/{session_id}/status.json"
+
+def write_status(session_id, stage, **details):
+    """Publish the pipeline's progress for a session as a single small status object."""
+    status = {
+        'session_id': session_id,
+        'stage': stage,
+        'progress': (PIPELINE_STAGES.index(stage) + 1) / len(PIPELINE_STAGES) if stage in PIPELINE_STAGES else None,
+        'updated_at': time.time(),
+        **details
+    }
+    write_to_s3(json.dumps(status), config.BUCKET_NAME, status_key(session_id))
+
+def load_status(session_id):
+    """Return the session's status object, or None if the pipeline hasn't started it yet."""
+    try:
+        return load_json_from_s3(status_key(session_id))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
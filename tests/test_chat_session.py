@@ -0,0 +1,50 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "front")))
+
+from chat_session import TOOL_RESULT_PREFIX, ChatSession
+
+def add_turn(chat, user_text, assistant_text):
+    chat.add("user", user_text)
+    chat.add("assistant", assistant_text)
+
+def add_tool_round(chat):
+    chat.add("assistant", "Logging it now.\n\n🔧 Claude is calling: `update_dive_information`")
+    chat.add("user", f"{TOOL_RESULT_PREFIX}`update_dive_information` succeeded: {{}}")
+
+def test_compact_keeps_recent_messages_after_a_tool_round():
+    chat = ChatSession()
+    for n in range(3):
+        add_turn(chat, f"question {n} " + "x" * 4000, f"answer {n} " + "y" * 4000)
+    chat.add("user", "log my dive")
+    add_tool_round(chat)
+
+    # The follow-up request after the tool result must not fold back to the latest user turn
+    context = chat.context_messages()
+
+    window = chat.messages[chat.window_start:]
+    assert len(window) >= chat.keep_recent
+    assert window[0]["role"] == "user" and not window[0]["content"].startswith(TOOL_RESULT_PREFIX)
+    assert any(m["content"] == "log my dive" for m in context)
+    assert context[-1]["content"].startswith(TOOL_RESULT_PREFIX)
+
+def test_compact_folds_old_turns_to_fit_the_budget():
+    chat = ChatSession(keep_recent=2)
+    for n in range(10):
+        add_turn(chat, f"question {n} " + "x" * 2000, f"answer {n} " + "y" * 2000)
+
+    chat.context_messages()
+
+    assert chat.context_tokens() <= chat.max_context_tokens
+    assert chat.messages[chat.window_start]["content"].startswith("question")
+    assert any("question 0" in line for line in chat.summary_lines)
+
+def test_compact_leaves_short_conversations_alone():
+    chat = ChatSession()
+    chat.add("user", "hi")
+    add_tool_round(chat)
+    chat.add("assistant", "howdy")
+
+    assert len(chat.context_messages()) == 4
+    assert chat.summary_lines == []